@@ -1,7 +1,12 @@
+import os
+import uuid
+
 import pandas as pd
 import streamlit as st
 from signf_app.analyzer import Analyzer
 from signf_app.common import VarTypes
+from signf_app.cache import ColumnCache
+from signf_app.compute import ComputeService
 from signf_app.loader import Loader
 
 # Streamlit docs
@@ -12,7 +17,7 @@ from signf_app.loader import Loader
 
 @st.cache
 def load_data(path, format='sql'):
-    loader = Loader()
+    loader = Loader(cache=ColumnCache())
     loader.auth()
     try:
         data = loader.load_test_data(path, format)
@@ -45,12 +50,32 @@ def generate_msg_power(power, min_power):
 def check_significance(p_val, alpha):
     return "YES" if p_val < alpha else "NO"
 
-@st.cache
+@st.cache(allow_output_mutation=True)
+def get_compute_service():
+    # One service per server, shared by all the sessions
+    return ComputeService(max_workers=int(os.environ.get("SIGNF_MAX_WORKERS", 2)))
+
+@st.cache(allow_output_mutation=True)
+def run_replicates(data, var_to_analyze, var_type, covariate=None):
+    # The replicates don't depend on alpha or the CI level, so moving the sliders reuses them.
+    # Identical analyses launched by other sessions at the same time attach to the same job.
+    analyzer = Analyzer(data=data, var_to_analyze=var_to_analyze, var_type=var_type, covariate=covariate)
+    quantiles = var_type == VarTypes.CONTINUOUS.value
+    return get_compute_service().run(
+        st.session_state.session_id,
+        (analyzer.fingerprint(), quantiles),
+        analyzer.run_replicates,
+        quantiles=quantiles
+        )
+
 def do_h0_testing(analyzer):
     return analyzer.do_h0_testing(figsize=(800,500))
 
 
 ################################
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
 st.write(
     """
 # 📊 A/B Testing App
@@ -74,6 +99,12 @@ st.dataframe(data.head())
 st.markdown("### Select Column for analysis")
 var_to_test = st.selectbox("Choose variable", data.select_dtypes(include='number').columns)
 vart_type = st.radio("Choose variable", ('continuous', 'proportion'))
+covariate = st.selectbox(
+    "Pre-experiment covariate (CUPED)",
+    ['None'] + [c for c in data.select_dtypes(include='number').columns if c != var_to_test],
+    help="Pre-period values of the variable used to reduce its variance",
+)
+covariate = None if covariate == 'None' else covariate
 
 
 with st.expander("Adjust test parameters"):
@@ -100,7 +131,7 @@ with st.expander("Adjust test parameters"):
         )
 
  
-if not st.button('Run Test'):
+if not st.checkbox('Run Test'):
     st.stop()
 
 ################################
@@ -110,8 +141,10 @@ analyzer = Analyzer(
     var_to_analyze = var_to_test,
     var_type = vart_type,
     alpha=alpha,
-    power = power
+    power = power,
+    covariate = covariate
 )
+analyzer.replicates = run_replicates(data, var_to_test, vart_type, covariate)
 
 
 st.markdown("### Sanity Checks")
@@ -124,6 +157,15 @@ if warning:
 else:
     st.info(smr_msg)
 
+st.markdown("#### Power Analysis")
+power_msg, warning = generate_msg_power(power_val, analyzer.power)
+if analyzer.cuped_summary is not None:
+    power_msg += f' CUPED reduced the variance by {analyzer.cuped_summary.variance_reduction.iloc[0]:.1%}.'
+if warning:
+    st.warning(power_msg)
+else:
+    st.info(power_msg)
+
 ################################
 
 st.markdown("### H0 Testing")
@@ -146,11 +188,14 @@ with col2:
 
 st.plotly_chart(f)
 
+st.markdown("### Bayesian Analysis")
+st.dataframe(analyzer.do_bayesian_analysis())
+
 
 ################################
 
 if analyzer.var_type == VarTypes.PROPORTION.value:
-    st.dataframe(Loader.aggregate_by_conversion(analyzer.data, analyzer.var_to_analyze))
+    st.dataframe(Loader.aggregate_by_conversion(analyzer.raw_data, analyzer.var_to_analyze))
     st.stop()
 
 else:
@@ -0,0 +1,47 @@
+"""
+Import-time benchmark. It imports signf_app.analyzer in fresh interpreters and fails if the
+best time goes over the startup budget or if a lazily loaded dependency was imported eagerly.
+
+Usage:
+    python benchmarks/import_time.py [--budget SECONDS] [--runs N]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Dependencies that should only be imported on first use
+LAZY_MODULES = ["scipy", "statsmodels", "plotly", "streamlit"]
+
+SNIPPET = f"""
+import json, sys, time
+t = time.perf_counter()
+import signf_app.analyzer
+elapsed = time.perf_counter() - t
+print(json.dumps({{"elapsed": elapsed, "eager": [m for m in {LAZY_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def measure(runs: int):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", SNIPPET], cwd=root, capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout))
+    return min(r["elapsed"] for r in results), sorted({m for r in results for m in r["eager"]})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=1.0, help="Startup budget in seconds. 1.0 by default")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh imports. 5 by default")
+    args = parser.parse_args()
+
+    elapsed, eager = measure(args.runs)
+    print(f"import signf_app.analyzer: {elapsed:.3f}s (budget {args.budget:.3f}s)")
+    if eager:
+        print(f"FAIL: imported eagerly: {', '.join(eager)}")
+    if elapsed > args.budget:
+        print("FAIL: over the startup budget")
+    sys.exit(1 if eager or elapsed > args.budget else 0)
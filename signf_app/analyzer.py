@@ -1,5 +1,6 @@
 
-from typing import Union, Tuple
+import hashlib
+from typing import Dict, List, Union, Tuple
 
 import numpy as np
 import pandas as pd
@@ -7,6 +8,10 @@ import pandas as pd
 from signf_app.checker import Checker
 from signf_app.resampler import Resampler
 from signf_app.bootstrapper import Bootstrapper
+from signf_app.replicates import ReplicateStore
+from signf_app.sketch import QuantileSketch
+from signf_app.bayesian import BayesianEstimator
+from signf_app.cuped import Cuped
 from signf_app.plotter import Plotter
 from signf_app.loader import Loader
 from signf_app.common import VarTypes
@@ -45,6 +50,16 @@ class Analyzer:
 
         power (float): Power parameter. Set to 0.8 by default.
 
+        strata (str): Optional column with the strata of the test (day, country, platform...). When it's set,
+        permutations and bootstrap resamples are confined within each stratum.
+
+        cluster (str): Optional column with the randomization unit when the rows are finer grained, e.g. the
+        user id when the rows are sessions or orders. It's used by do_cluster_bootstrap.
+
+        covariate (str): Optional pre-period covariate of var_to_analyze, e.g. the same metric before the test.
+        When it's set, var_to_analyze is replaced by its CUPED adjusted values (see cuped.Cuped) in every 
+        analysis, the original data is kept in raw_data and the achieved variance reduction in cuped_summary.
+
 
     """
     # TODO -> Add Logger
@@ -56,7 +71,10 @@ class Analyzer:
         var_type: VarTypes,
         alpha: float = 0.05,
         power: float = 0.8, 
-        nrg: np.random = np.random.default_rng()
+        nrg: np.random = np.random.default_rng(),
+        strata: str = None,
+        cluster: str = None,
+        covariate: str = None
         ) -> None:
 
         # TODO -> Add check if data does not contain the variant column. Or should I include it as parameter?
@@ -67,20 +85,41 @@ class Analyzer:
         if var_to_analyze not in data.columns:
             raise Exception('Variable is not in dataframe')
 
+        if strata is not None and strata not in data.columns:
+            raise Exception('Strata column is not in dataframe')
+
+        if cluster is not None and cluster not in data.columns:
+            raise Exception('Cluster column is not in dataframe')
+
+        if covariate is not None and covariate not in data.columns:
+            raise Exception('Covariate column is not in dataframe')
+
         if var_type not in [ x.value for x in VarTypes]:
             raise Exception('DataType is not supported. Choose one of "proportion" or "continuous"')
 
+        self.raw_data = data
         self.data = data
         self.var_to_analyze = var_to_analyze
         self.var_type = var_type
         self.alpha = alpha
         self.power = power
         self.nrg = nrg
+        self.strata = strata
+        self.cluster = cluster
+        self.covariate = covariate
+        self.cuped_summary = None
+        if self.covariate is not None:
+            self.data, self.cuped_summary = Cuped.adjust(self.data, {self.var_to_analyze: self.covariate})
+        self.replicates = ReplicateStore()
+        self.sufficient_stats = pd.DataFrame()
 
         # TODO -> Create func to abstract this
         self.control, self.variant = Loader.split_control_variation_from_data(self.data)
         self.control_series = self.control[self.var_to_analyze]
         self.variant_series = self.variant[self.var_to_analyze]
+        if self.strata is not None:
+            self.control_strata = self.control[self.strata]
+            self.variant_strata = self.variant[self.strata]
 
     
     def do_sanity_checks(self):
@@ -90,6 +129,9 @@ class Analyzer:
             - Sample Ratio Mismatch (SMR) which verifies that the sampling between control and variation are not statistically different
             - Power Analysis which verifies that we have enough sample to draw conclusions for the chosen variable at a adequate level of robutness 
 
+        With a covariate, the power is computed on the CUPED adjusted variable, so it accounts for the variance 
+        reduction achieved, which is reported in cuped_summary.
+
         Returns:
             smr_check (str) : Message that contains the result of the SMR check. The message indicates if there are warnings or not.
             power_check(str) : Message that contains the result of the Power check. The message indicates if there are warnings or not.
@@ -103,12 +145,12 @@ class Analyzer:
 
 
         # TODO do the logic here for diff checks as the proportion requires a preaggregation.
-        if self.var_type == VarTypes.CONTINUOUS.value:
+        if self.var_type == VarTypes.CONTINUOUS.value or self.covariate is not None:
             # print(self.var_type)
             power = checker.calculate_power_for_mean(self.control_series, self.variant_series)
             # print(power)
         
-        if self.var_type == VarTypes.PROPORTION.value:
+        elif self.var_type == VarTypes.PROPORTION.value:
             # print(self.var_type)
             agg_data = Loader.aggregate_by_conversion(self.data, self.var_to_analyze)
             agg_control, agg_variant = Loader.split_control_variation_from_data(agg_data)
@@ -123,43 +165,36 @@ class Analyzer:
         return smr_check, power
 
 
-    def do_h0_testing(
-        self, 
-        figsize: Tuple[int, int] = (800,600),
-        backend: str = "plotly"
-        ):
-
+    def _simulate_h0_diffs(self) -> Tuple[float, np.array]:
         """
-        This method performs a Hyphotesis testing under the simulation framework. It uses resampling under the hood.
-        The idea is to simulate the null hyphotesis, H0, and compare the results with the observed treatment effect. 
-        The p-val is calculated as the # of times the exp treatment effect is observed comparing it with respect to the
-        H0 simulation. The test is represented through a Histogram of the simulated differences.
-        Reference: https://allendowney.github.io/ElementsOfDataScience/13_hypothesis.html
-
-        Args:
-            figsize (int, int): A (width, height) tuple that specifies the size of the returned figure.
-
-        Returns:
-            p_val (float): The p_val from the test
-            f (Figure): A Figure that represents the test. It's an histogram of the simulated differences.
-
+        Simulates the H0 by resampling and returns the observed treatment effect along with the 
+        simulated differences of means.
         """
-        
         resampler = Resampler(self.nrg)
 
        
         # Treatment effect
         test_statistic = self.variant_series.mean() - self.control_series.mean()
 
-        if self.var_type == VarTypes.CONTINUOUS.value:
-            # Shuffle data
+        if self.strata is not None:
+            # Shuffle data within each stratum. It applies to both continuous and 0/1 proportion data
+            control_means_h0, variant_means_h0 = resampler.simulate_cont_under_h0_stratified(
+                self.control_series, 
+                self.variant_series, 
+                self.control_strata, 
+                self.variant_strata
+                )
+            diff_of_means_h0 = variant_means_h0 - control_means_h0
+
+        elif self.var_type == VarTypes.CONTINUOUS.value or self.covariate is not None:
+            # Shuffle data. CUPED adjusted proportions are no longer 0/1 so they're permuted as well
             control_h0, variant_h0 = resampler.simulate_cont_under_h0(self.control_series, self.variant_series)
 
             # test statistics h0
             diff_of_means_h0 = np.mean(variant_h0, axis=1) - np.mean(control_h0, axis=1)
 
 
-        if self.var_type == VarTypes.PROPORTION.value:
+        elif self.var_type == VarTypes.PROPORTION.value:
             # Shuffle data
             effect_h0 = self.control_series.sum() + self.variant_series.sum()
             n_control, n_variant = len(self.control_series), len(self.variant_series)
@@ -168,11 +203,82 @@ class Analyzer:
             diff_of_means_h0 = variant_h0 - control_h0
         
      
-        #P value
-        # TODO: take account which tail the effect is -> DONE
-        p_sim = (diff_of_means_h0 <= test_statistic).mean()
-        p_val = min([p_sim, 1 - p_sim])
-    
+        return test_statistic, diff_of_means_h0
+
+
+    def fingerprint(self) -> str:
+        """
+        Hash of the data and parameters that determine the replicates of the test (not alpha, power or the
+        CI level). Two analyses with the same fingerprint produce equivalent results, which is what
+        compute.ComputeService uses to de-duplicate them.
+        """
+        cols = ["variant", self.var_to_analyze] + ([self.strata] if self.strata is not None else [])
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(pd.util.hash_pandas_object(self.data[cols], index=False).values.tobytes())
+        digest.update(f"{self.var_to_analyze}|{self.var_type}|{self.strata}|{self.covariate}".encode())
+        return digest.hexdigest()
+
+
+    def run_replicates(self, quantiles: bool = True, n_iter_bootstrap: int = 100) -> ReplicateStore:
+        """
+        Runs the simulations of the test and keeps their raw results in self.replicates. Only the parts that
+        are missing are computed, so changing alpha, the CI level or the quantiles never resamples again.
+        The store can be shared between instances analyzing the same data, e.g. to cache it in the app.
+
+        Args:
+            quantiles (bool): If True, also bootstrap the quantiles on the internal quantile grid
+            n_iter_bootstrap (int): Number of bootstrap samples for the quantiles
+
+        Returns:
+            replicates (ReplicateStore): The store with the H0 and bootstrap replicates
+        """
+        if not self.replicates.has_h0:
+            self.replicates.test_statistic, self.replicates.h0_diffs = self._simulate_h0_diffs()
+
+        if quantiles and not self.replicates.has_quantiles:
+            bootstraper = Bootstrapper(self.nrg)
+            grid = ReplicateStore.QUANTILE_GRID
+            control_q, variant_q = bootstraper.generate_quantile_replicates(
+                control=self.control_series,
+                variant=self.variant_series,
+                q=grid,
+                n_iter=n_iter_bootstrap,
+                control_strata=self.control_strata if self.strata is not None else None,
+                variant_strata=self.variant_strata if self.strata is not None else None
+                )
+            self.replicates.quantile_grid = grid
+            self.replicates.control_quantiles = control_q
+            self.replicates.variant_quantiles = variant_q
+
+        return self.replicates
+
+
+    def do_h0_testing(
+        self, 
+        figsize: Tuple[int, int] = (800,600),
+        backend: str = "plotly"
+        ):
+
+        """
+        This method performs a Hyphotesis testing under the simulation framework. It uses resampling under the hood.
+        The idea is to simulate the null hyphotesis, H0, and compare the results with the observed treatment effect. 
+        The p-val is calculated as the # of times the exp treatment effect is observed comparing it with respect to the
+        H0 simulation. The test is represented through a Histogram of the simulated differences.
+        Reference: https://allendowney.github.io/ElementsOfDataScience/13_hypothesis.html
+
+        Args:
+            figsize (int, int): A (width, height) tuple that specifies the size of the returned figure.
+
+        Returns:
+            p_val (float): The p_val from the test
+            f (Figure): A Figure that represents the test. It's an histogram of the simulated differences.
+
+        """
+        
+        replicates = self.run_replicates(quantiles=False)
+        test_statistic = replicates.test_statistic
+        diff_of_means_h0 = replicates.h0_diffs
+        p_val = replicates.p_value()
 
         f = Plotter.plot_h0_results(
             diff_of_means_h0, 
@@ -189,7 +295,8 @@ class Analyzer:
         self, 
         max_cap: Union[int, float] = None, 
         figsize: Tuple[int, int]  = (800,600),
-        backend: str = "plotly"
+        backend: str = "plotly",
+        cap_quantile: float = None
         ):
         
         """
@@ -199,20 +306,259 @@ class Analyzer:
         Args:
             max_cap (int, float): A parameters that controls the maximum value to display in the return Figure
             figsize (int, int) : A (width, height) tuple that specifies the size of the returned figure.
+            cap_quantile (float): Quantile used to cap the outliers automatically when max_cap is not given, e.g. 0.99
 
         Returns:
             f: A Figure that contains the histograms of both control and variant  
         
         """
-        f = Plotter.plot_hist(self.data, self.var_to_analyze, cap=max_cap, figsize=figsize, backend=backend)
+        f = Plotter.plot_hist(
+            self.data, 
+            self.var_to_analyze, 
+            cap=max_cap, 
+            figsize=figsize, 
+            backend=backend, 
+            cap_quantile=cap_quantile
+            )
         return f
 
 
+    def get_sufficient_statistics(self, metrics: List[str]) -> pd.DataFrame:
+        """
+        Returns the sufficient statistics (count, sum, sum of squares per variant) of metrics. They are cached
+        so only the metrics not seen yet are aggregated.
+        """
+        missing = [m for m in metrics if m not in self.sufficient_stats.columns.get_level_values(0)]
+        if missing:
+            stats = Loader.sufficient_statistics(self.data, missing)
+            self.sufficient_stats = stats if self.sufficient_stats.empty else pd.concat([self.sufficient_stats, stats], axis=1)
+        return self.sufficient_stats[metrics]
+
+
+    def do_bayesian_analysis(
+        self,
+        metrics: Dict[str, str] = None,
+        ci: float = None,
+        n_draws: int = 20000
+        ) -> pd.DataFrame:
+        """
+        Bayesian analysis of the test: for each metric and variant it gives the probability of beating control,
+        the probability of being the best variant, the expected loss and credible intervals. It uses conjugate
+        models (Beta-Binomial for proportions and Normal-Inverse-Gamma for continuous metrics) computed from the
+        cached sufficient statistics, so many metrics are scored in a single batch of posterior draws.
+
+        Args:
+            metrics (dict): Metrics to analyze and their type, e.g. {"revenue": "continuous", "conversion": "proportion"}.
+            By default the analyzed variable. With a covariate, the CUPED adjusted variable is no longer 0/1, so
+            it's always scored with the continuous model.
+            ci (float): Level of the credible intervals, in percent. By default it's (1 - alpha) * 100.
+            n_draws (int): Number of posterior draws
+
+        Returns:
+            scorecard (pd.DataFrame): One row per metric and variant with the posterior summary
+        """
+        if metrics is None:
+            metrics = {self.var_to_analyze: self.var_type}
+
+        if any(t not in [x.value for x in VarTypes] for t in metrics.values()):
+            raise Exception('DataType is not supported. Choose one of "proportion" or "continuous"')
+
+        if ci is None:
+            ci = (1 - self.alpha) * 100
+
+        if self.covariate is not None and self.var_to_analyze in metrics:
+            metrics = {**metrics, self.var_to_analyze: VarTypes.CONTINUOUS.value}
+
+        stats = self.get_sufficient_statistics(list(metrics))
+        estimator = BayesianEstimator(self.nrg, n_draws=n_draws)
+        return estimator.analyze(stats, list(metrics), list(metrics.values()), ci)
+
+
+    def do_cluster_bootstrap(
+        self,
+        n_iter: int = 1000,
+        method: str = "poisson",
+        ci: float = None
+        ) -> Tuple[float, float, Tuple[float, float]]:
+        """
+        Tests the difference of means resampling clusters instead of rows. When the randomization is by user but
+        the rows are sessions or orders, rows of the same user are correlated and resampling them independently
+        understates the variance. Each variant is bootstrapped by cluster, see 
+        bootstrapper.Bootstrapper.generate_cluster_mean_replicates, and the p-val is the share of replicates of 
+        the difference on the other side of 0.
+
+        Args:
+            n_iter (int): Number of bootstrap replicates
+            method (str): Distribution of the cluster weights, "poisson" (default) or "multinomial"
+            ci (float): Level of the confidence interval, in percent. By default it's (1 - alpha) * 100.
+
+        Returns:
+            effect (float): Observed difference of means between variant and control
+            p_val (float): The p_val from the test
+            ci_interval (float, float): Confidence interval of the difference
+        """
+        if self.cluster is None:
+            raise Exception('Analyzer was created without a cluster column')
+
+        if ci is None:
+            ci = (1 - self.alpha) * 100
+
+        bootstraper = Bootstrapper(self.nrg)
+        control_means = bootstraper.generate_cluster_mean_replicates(
+            self.control_series, self.control[self.cluster], n_iter=n_iter, method=method
+            )
+        variant_means = bootstraper.generate_cluster_mean_replicates(
+            self.variant_series, self.variant[self.cluster], n_iter=n_iter, method=method
+            )
+        diffs = variant_means - control_means
+        # Replicates without a mean must not count on either side of 0
+        diffs = diffs[~np.isnan(diffs)]
+
+        effect = self.variant_series.mean() - self.control_series.mean()
+        p_sim = (diffs <= 0).mean()
+        p_val = min([p_sim, 1 - p_sim])
+        lower, upper = bootstraper.generate_ci_interval(diffs, ci)
+        return effect, p_val, (lower, upper)
+
+
+    def do_segmented_analysis(
+        self,
+        segments: List[str],
+        n_iter: int = 1000,
+        correction: str = "fdr_bh"
+        ) -> pd.DataFrame:
+        """
+        Breaks the test down by the values of one or more segment columns (country, device, platform...) without
+        splitting the data or creating an Analyzer per segment. For each segment column:
+            - The counts and means per (segment, variant) come from one grouped reduction.
+            - The SRM check of every segment is a vectorized chi-square on those counts.
+            - The H0 test of every segment comes from one batch of permutations within segments, see
+            resampler.Resampler.simulate_segment_diffs_under_h0. If the analyzer has strata, they're respected.
+
+        Rows with a missing metric or segment are left out of the breakdown of that segment column.
+
+        As many segments are tested at once, the p-vals of the H0 tests and the SRM checks are adjusted for
+        multiple testing.
+
+        Args:
+            segments (list): Columns to break the test down by
+            n_iter (int): Number of permutations
+            correction (str): Multiple testing correction, any method of statsmodels multipletests
+            e.g. "fdr_bh" (default), "holm" or "bonferroni"
+
+        Returns:
+            breakdown (pd.DataFrame): One row per segment column and value with the counts, means, treatment 
+            effect, p-vals and SRM check
+        """
+        from scipy.stats import chi2
+        from statsmodels.stats.multitest import multipletests
+
+        missing = [s for s in segments if s not in self.data.columns]
+        if missing:
+            raise Exception(f'Segment columns are not in dataframe: {", ".join(missing)}')
+
+        data = pd.concat([self.control, self.variant], ignore_index=True)
+        is_control = np.arange(len(data)) < len(self.control)
+        resampler = Resampler(self.nrg)
+
+        results = []
+        for segment in segments:
+            # Rows without the metric or the segment are left out of both the stats and the simulation
+            valid = (data[self.var_to_analyze].notna() & data[segment].notna()).to_numpy()
+            segment_data = data[valid]
+            stats = segment_data.groupby([segment, "variant"])[self.var_to_analyze].agg(["count", "mean"])
+            stats = stats.unstack("variant").sort_index()
+            stats = stats.reindex(columns=pd.MultiIndex.from_product([["count", "mean"], ["Control", "Variation1"]]))
+            n_control = stats[("count", "Control")].fillna(0).to_numpy()
+            n_variant = stats[("count", "Variation1")].fillna(0).to_numpy()
+            control_mean = stats[("mean", "Control")].to_numpy()
+            variant_mean = stats[("mean", "Variation1")].to_numpy()
+            effect = variant_mean - control_mean
+
+            # The codes come from the index of stats, so the simulated columns line up with its rows
+            diffs_h0 = resampler.simulate_segment_diffs_under_h0(
+                segment_data[self.var_to_analyze], 
+                is_control[valid], 
+                stats.index.get_indexer(segment_data[segment]), 
+                len(stats), 
+                strata=segment_data[self.strata] if self.strata is not None else None,
+                n_iter=n_iter
+                )
+            p_sim = (diffs_h0 <= effect).mean(axis=0)
+            p_val = np.where(np.isnan(effect), np.nan, np.minimum(p_sim, 1 - p_sim))
+
+            # SRM: chi-square of the observed split against an even split, one per segment
+            expected = (n_control + n_variant) / 2
+            with np.errstate(divide="ignore", invalid="ignore"):
+                chi_stat = ((n_control - expected) ** 2 + (n_variant - expected) ** 2) / expected
+            srm_p_val = chi2.sf(chi_stat, df=1)
+
+            results.append(pd.DataFrame({
+                "segment": segment,
+                "segment_value": stats.index,
+                "n_control": n_control.astype(int),
+                "n_variant": n_variant.astype(int),
+                "control_mean": control_mean,
+                "variant_mean": variant_mean,
+                "effect": effect,
+                "p_val": p_val,
+                "srm_p_val": srm_p_val
+            }))
+
+        breakdown = pd.concat(results, ignore_index=True)
+        for col in ["p_val", "srm_p_val"]:
+            tested = breakdown[col].notna()
+            adjusted = np.full(len(breakdown), np.nan)
+            if tested.any():
+                adjusted[tested.to_numpy()] = multipletests(breakdown.loc[tested, col], alpha=self.alpha, method=correction)[1]
+            breakdown[f"{col}_adj"] = adjusted
+
+        breakdown["significant"] = breakdown["p_val_adj"] < self.alpha
+        breakdown["srm_warning"] = breakdown["srm_p_val_adj"] < self.alpha
+        return breakdown
+
+
+    def do_approx_quantile_treatment_effect(
+        self, 
+        q: np.array = np.linspace(0.01,1,100, endpoint=False), 
+        rank_error: float = 0.01,
+        sketches: Dict[str, QuantileSketch] = None
+        ) -> pd.DataFrame:
+        """
+        Approximate quantile treatment effect read from a quantile sketch of each variant. Unlike
+        do_quantile_treatment_effect there's no bootstrap, so there are no confidence intervals, but it
+        runs in bounded memory and the sketches can come from a streaming pass, e.g. Loader.sketch_data.
+
+        Args:
+            q (np.array): the quantiles to be used. They should be between 0 and 1.
+            rank_error (float): Target rank error of the sketches built from the data
+            sketches (dict): Optional sketches per variant. If not given, they're built from the data.
+
+        Returns:
+            data (pd.DataFrame): Dataframe with the percentiles, the control and variant quantiles and their difference
+        """
+        if sketches is None:
+            sketches = {
+                "Control": QuantileSketch.from_values(self.control_series, rank_error, nrg=self.nrg),
+                "Variation1": QuantileSketch.from_values(self.variant_series, rank_error, nrg=self.nrg)
+            }
+
+        control_q = sketches["Control"].quantile(q)
+        variant_q = sketches["Variation1"].quantile(q)
+        return pd.DataFrame({
+            "percentiles": q,
+            "control": control_q,
+            "variant": variant_q,
+            "diff": variant_q - control_q
+        })
+
+
     def do_quantile_treatment_effect(
         self, 
         q: np.array = np.linspace(0.01,1,100, endpoint=False), 
         figsize: Tuple[int, int] = (800,600),
-        plot_backend: str = 'plotly'
+        plot_backend: str = 'plotly',
+        ci: float = None
         ):
 
         """
@@ -224,23 +570,19 @@ class Analyzer:
         Args:
             q (np.array): the quantiles to be used. They should be between 0 and 1.
             figsize (int, int) : A (width, height) tuple that specifies the size of the returned figure.
+            ci (float): Confidence level of the intervals, in percent. By default it's (1 - alpha) * 100.
 
         Returns:
             f: A Figure that contains the plot of the quantiles differences with the confidence intervals. 
 
         """
 
-        bootstraper = Bootstrapper(self.nrg)
-
-        quantiles_bootstrapped = bootstraper.generate_quantile_bootstrap_raw(
-            control=self.control_series,
-            variant=self.variant_series,
-            q = q)
-            
+        if ci is None:
+            ci = (1 - self.alpha) * 100
 
-        summarize_quantile = bootstraper.summarize_quantile_effect(quantiles_bootstrapped)
+        summarize_quantile = self.run_replicates().summarize_quantile_effect(q, ci)
 
-        f = Plotter.plot_quantile_effect(summarize_quantile, varname=self.var_to_analyze, figsize = figsize, backend=plot_backend)
+        f = Plotter.plot_quantile_effect(summarize_quantile, varname=self.var_to_analyze, figsize = figsize, ci = ci, backend=plot_backend)
         return f
 
 
@@ -0,0 +1,166 @@
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+class BayesianEstimator:
+    """
+    The BayesianEstimator class performs a conjugate Bayesian analysis of a test from sufficient statistics only
+    (count, sum and sum of squares per arm), so it never goes back to the raw data. It supports:
+        - Beta-Binomial for proportion metrics. Prior Beta(prior_alpha, prior_beta), uniform by default.
+        - Normal with a Normal-Inverse-Gamma prior for continuous metrics. The marginal posterior of the mean is a
+        Student-t. The default prior is the weak limit (kappa0 = alpha0 = beta0 = 0).
+
+    Every posterior is sampled in a single vectorized batch of shape (n_metrics, n_arms, n_draws), so a full
+    scorecard with many metrics and arms is one array operation. The first arm is the control.
+
+    For each metric and arm it reports the posterior mean with its credible interval, the credible interval of the
+    difference to control, P(arm beats control), P(arm is the best) and the expected loss of choosing the arm,
+    i.e. how much we lose on average if it's not the best one.
+
+    Reference: https://www.evanmiller.org/bayesian-ab-testing.html
+    """
+
+    def __init__(
+        self,
+        nrg: np.random = np.random.default_rng(),
+        n_draws: int = 20000,
+        prior_alpha: float = 1.0,
+        prior_beta: float = 1.0,
+        mu0: float = 0.0,
+        kappa0: float = 0.0,
+        alpha0: float = 0.0,
+        beta0: float = 0.0
+        ) -> None:
+        self.nrg = nrg
+        self.n_draws = n_draws
+        self.prior_alpha = prior_alpha
+        self.prior_beta = prior_beta
+        self.mu0 = mu0
+        self.kappa0 = kappa0
+        self.alpha0 = alpha0
+        self.beta0 = beta0
+
+    def sample_proportion(self, n: np.array, successes: np.array) -> np.array:
+        """
+        Draws from the Beta posterior of the conversion rate of each metric and arm.
+
+        Args:
+            n (np.array): Number of trials, any shape e.g. (n_metrics, n_arms)
+            successes (np.array): Number of successes, same shape as n
+
+        Returns:
+            draws (np.array): Posterior draws with shape n.shape + (n_draws,)
+        """
+        n, successes = np.asarray(n, dtype=float), np.asarray(successes, dtype=float)
+        a = (self.prior_alpha + successes)[..., None]
+        b = (self.prior_beta + n - successes)[..., None]
+        return self.nrg.beta(a, b, size=n.shape + (self.n_draws,))
+
+    def sample_mean(self, n: np.array, sum_: np.array, sum_sq: np.array) -> np.array:
+        """
+        Draws from the Normal-Inverse-Gamma marginal posterior (a Student-t) of the mean of each metric and arm.
+
+        Args:
+            n (np.array): Number of observations, any shape e.g. (n_metrics, n_arms)
+            sum_ (np.array): Sum of the observations, same shape as n
+            sum_sq (np.array): Sum of the squared observations, same shape as n
+
+        Returns:
+            draws (np.array): Posterior draws with shape n.shape + (n_draws,)
+        """
+        n, sum_, sum_sq = (np.asarray(x, dtype=float) for x in (n, sum_, sum_sq))
+        mean = sum_ / n
+        ss = np.maximum(sum_sq - n * mean ** 2, 0)
+
+        kappa_n = self.kappa0 + n
+        mu_n = (self.kappa0 * self.mu0 + n * mean) / kappa_n
+        alpha_n = self.alpha0 + n / 2
+        beta_n = self.beta0 + ss / 2 + self.kappa0 * n * (mean - self.mu0) ** 2 / (2 * kappa_n)
+        scale = np.sqrt(beta_n / (alpha_n * kappa_n))
+
+        t = self.nrg.standard_t((2 * alpha_n)[..., None], size=n.shape + (self.n_draws,))
+        return mu_n[..., None] + scale[..., None] * t
+
+    @staticmethod
+    def summarize_draws(draws: np.array, ci: float = 95) -> dict:
+        """
+        Reduces posterior draws of shape (n_metrics, n_arms, n_draws) to the decision metrics of each metric and arm.
+
+        Args:
+            draws (np.array): Posterior draws. The first arm is the control.
+            ci (float): Level of the credible intervals, in percent
+
+        Returns:
+            summary (dict): Arrays of shape (n_metrics, n_arms) with the posterior mean, the credible interval,
+            the credible interval of the difference to control, P(beats control), P(best) and the expected loss
+        """
+        tail = (100 - ci) / 2
+        diff = draws - draws[:, :1]
+        best = draws.max(axis=1, keepdims=True)
+        lower, upper = np.percentile(draws, [tail, 100 - tail], axis=-1)
+        diff_lower, diff_upper = np.percentile(diff, [tail, 100 - tail], axis=-1)
+        n_arms = draws.shape[1]
+        return {
+            "posterior_mean": draws.mean(axis=-1),
+            "lower": lower,
+            "upper": upper,
+            "diff_lower": diff_lower,
+            "diff_upper": diff_upper,
+            "prob_beats_control": (diff > 0).mean(axis=-1),
+            "prob_best": (draws.argmax(axis=1)[:, None, :] == np.arange(n_arms)[None, :, None]).mean(axis=-1),
+            "expected_loss": (best - draws).mean(axis=-1)
+        }
+
+    def analyze(
+        self,
+        stats: pd.DataFrame,
+        metrics: List[str],
+        var_types: List[str],
+        ci: float = 95
+        ) -> pd.DataFrame:
+        """
+        Bayesian scorecard of several metrics and arms. The proportion metrics and the continuous ones are each
+        sampled in one batch.
+
+        Args:
+            stats (pd.DataFrame): Sufficient statistics as returned by Loader.sufficient_statistics, one row per
+            arm (control first) and the columns (metric, "n"), (metric, "sum") and (metric, "sum_sq")
+            metrics (list): Metrics to analyze
+            var_types (list): Type of each metric, "proportion" or "continuous"
+            ci (float): Level of the credible intervals, in percent
+
+        Returns:
+            scorecard (pd.DataFrame): One row per metric and arm with the posterior summary
+        """
+        arms = list(stats.index)
+        results = []
+        for var_type, sampler in (("proportion", self._sample_proportion_stats), ("continuous", self._sample_mean_stats)):
+            selected = [m for m, t in zip(metrics, var_types) if t == var_type]
+            if not selected:
+                continue
+            summary = self.summarize_draws(sampler(stats, selected), ci)
+            scorecard = pd.DataFrame({
+                "metric": np.repeat(selected, len(arms)),
+                "variant": np.tile(arms, len(selected)),
+                "var_type": var_type
+            })
+            for name, values in summary.items():
+                scorecard[name] = values.ravel()
+            results.append(scorecard)
+
+        scorecard = pd.concat(results, ignore_index=True)
+        order = {m: i for i, m in enumerate(metrics)}
+        return scorecard.sort_values("metric", key=lambda s: s.map(order), kind="stable").reset_index(drop=True)
+
+    def _sample_proportion_stats(self, stats: pd.DataFrame, metrics: List[str]) -> np.array:
+        n = np.stack([stats[(m, "n")].to_numpy() for m in metrics])
+        successes = np.stack([stats[(m, "sum")].to_numpy() for m in metrics])
+        return self.sample_proportion(n, successes)
+
+    def _sample_mean_stats(self, stats: pd.DataFrame, metrics: List[str]) -> np.array:
+        n = np.stack([stats[(m, "n")].to_numpy() for m in metrics])
+        sum_ = np.stack([stats[(m, "sum")].to_numpy() for m in metrics])
+        sum_sq = np.stack([stats[(m, "sum_sq")].to_numpy() for m in metrics])
+        return self.sample_mean(n, sum_, sum_sq)
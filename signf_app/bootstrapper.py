@@ -1,6 +1,10 @@
+from typing import Tuple
+
 import numpy as np
 import pandas as pd
 
+from signf_app.common import get_strata_layout
+
 
 class Bootstrapper:
     # TODO -> Add Docstring
@@ -53,19 +57,126 @@ class Bootstrapper:
             result_list.append(df)
         return pd.concat(result_list, ignore_index = True)
 
+    def _bootstrap_quantiles_stratified(
+        self, 
+        series: pd.Series, 
+        strata: pd.Series, 
+        q = np.arange(0, 1.1, 0.1), 
+        n_iter: int = 100,
+        max_batch_cells: int = 2 ** 22
+        ) -> np.array:
+        """
+        Draws n_iter bootstrap samples of series where each stratum keeps its original size, i.e. rows are
+        only resampled with replacement inside their own stratum, and returns their quantiles. The series is 
+        sorted once by stratum and every draw is an offset into its segment. The samples are drawn in batches 
+        of at most max_batch_cells values and each batch is reduced to its quantiles, so the memory stays bounded.
+
+        Args:
+            series (pd.Series): Values to resample
+            strata (pd.Series): Stratum of each row of series
+            q (np.array): the quantiles to be used. They should be between 0 and 1.
+            n_iter (int): Number of bootstrap samples
+            max_batch_cells (int): Maximum size of a batch of samples
+
+        Returns:
+            quantiles (np.array): (n_iter, len(q)) array with the quantiles of the bootstrapped samples
+        """
+        order, codes, starts, counts = get_strata_layout(strata)
+        values = np.asarray(series)[order]
+        segment_starts, segment_counts = starts[codes], counts[codes]
+        batch_size = max(1, max_batch_cells // len(values))
+
+        quantiles = []
+        for start in range(0, n_iter, batch_size):
+            u = self.nrg.random(size=(min(batch_size, n_iter - start), len(values)))
+            idx = segment_starts + (u * segment_counts).astype(np.int64)
+            quantiles.append(np.quantile(values[idx], q, axis=1).T)
+        return np.concatenate(quantiles)
+
+    def generate_quantile_bootstrap_raw_stratified(
+        self, 
+        control: pd.Series, 
+        variant: pd.Series, 
+        control_strata: pd.Series, 
+        variant_strata: pd.Series, 
+        q = np.arange(0, 1.1, 0.1), 
+        n_iter: int = 100
+        ) -> pd.DataFrame:
+        """
+        Stratified version of generate_quantile_bootstrap_raw. Resamples are confined within each stratum and
+        the quantiles of the bootstrap samples are computed in batches. The output has the same scheme as 
+        generate_quantile_bootstrap_raw so it can be passed to summarize_quantile_effect.
+
+        Args:
+            control (pd.Series): Values of the chosen variable in the control group
+            variant (pd.Series): Values of the chosen variable in the variant group
+            control_strata (pd.Series): Stratum of each row of control
+            variant_strata (pd.Series): Stratum of each row of variant
+            q (np.array): the quantiles to be used. They should be between 0 and 1.
+            n_iter (int): Number of bootstrap samples
+
+        Returns:
+            data (pd.DataFrame): Long dataframe with the columns index (quantile), control and variant
+        """
+        control_q, variant_q = self.generate_quantile_replicates(
+            control, variant, q, n_iter, control_strata=control_strata, variant_strata=variant_strata
+            )
+        return pd.DataFrame({
+            "index": np.tile(q, n_iter),
+            "control": control_q.ravel(),
+            "variant": variant_q.ravel()
+        })
+
+    def generate_quantile_replicates(
+        self, 
+        control: pd.Series, 
+        variant: pd.Series, 
+        q = np.arange(0, 1.1, 0.1), 
+        n_iter: int = 100,
+        control_strata: pd.Series = None,
+        variant_strata: pd.Series = None
+        ) -> Tuple[np.array, np.array]:
+        """
+        Compact version of generate_quantile_bootstrap_raw: instead of a long dataframe it returns the 
+        quantiles of every bootstrap sample as a replicate matrix, which is what replicates.ReplicateStore keeps.
+        If the strata are given, the resamples are confined within each stratum.
+
+        Args:
+            control (pd.Series): Values of the chosen variable in the control group
+            variant (pd.Series): Values of the chosen variable in the variant group
+            q (np.array): the quantiles to be used. They should be between 0 and 1.
+            n_iter (int): Number of bootstrap samples
+            control_strata (pd.Series): Optional stratum of each row of control
+            variant_strata (pd.Series): Optional stratum of each row of variant
+
+        Returns:
+            control_q (np.array): (n_iter, len(q)) array with the bootstrapped quantiles of control
+            variant_q (np.array): (n_iter, len(q)) array with the bootstrapped quantiles of variant
+        """
+        if control_strata is not None:
+            control_q = self._bootstrap_quantiles_stratified(control, control_strata, q, n_iter)
+            variant_q = self._bootstrap_quantiles_stratified(variant, variant_strata, q, n_iter)
+            return control_q, variant_q
+
+        control_q, variant_q = [], []
+        for i in range(n_iter):
+            control_q.append(self._get_quantiles(self._bootstrap_series(control), q))
+            variant_q.append(self._get_quantiles(self._bootstrap_series(variant), q))
+        return np.array(control_q), np.array(variant_q)
+
 
     @staticmethod
-    def _get_lower(series):
+    def _get_lower(series, ci: float = 95):
         # TODO -> Add Typing
-        return series.quantile(0.025)
+        return series.quantile((100 - ci) / 200)
 
     @staticmethod
-    def _get_upper(series):
+    def _get_upper(series, ci: float = 95):
         # TODO -> Add Typing
-        return series.quantile(0.975)
+        return series.quantile(1 - (100 - ci) / 200)
 
     
-    def summarize_quantile_effect(self, quantiles_bootstrapped):
+    def summarize_quantile_effect(self, quantiles_bootstrapped, ci: float = 95):
         # TODO -> Add Docstring
         # TODO -> Add Typing
         quantiles_effect_summarize = quantiles_bootstrapped\
@@ -77,8 +188,8 @@ class Bootstrapper:
                                         variant_mean = ("variant", "mean"),
                                         control_mean = ("control", "mean"),
                                         diff_mean = ("variant_to_control", "mean"),
-                                        diff_lower = ("variant_to_control", self._get_lower),
-                                        diff_upper = ("variant_to_control", self._get_upper)
+                                        diff_lower = ("variant_to_control", lambda x: self._get_lower(x, ci)),
+                                        diff_upper = ("variant_to_control", lambda x: self._get_upper(x, ci))
                                     )\
                                     .rename(columns={'index':'percentiles'})\
                                     .assign(
@@ -87,6 +198,122 @@ class Bootstrapper:
         
         return quantiles_effect_summarize
 
+    @staticmethod
+    def aggregate_clusters(series: pd.Series, clusters: pd.Series) -> Tuple[np.array, np.array]:
+        """
+        Aggregates the rows of series by cluster (e.g. the user id when the rows are sessions or orders).
+        Missing values are ignored. Rows without a cluster id (e.g. logged-out sessions) are not related
+        to any other row, so each one is its own singleton cluster.
+
+        Args:
+            series (pd.Series): Values of the chosen variable, one per row
+            clusters (pd.Series): Cluster of each row
+
+        Returns:
+            sums (np.array): Sum of the values of each cluster
+            counts (np.array): Number of rows of each cluster
+        """
+        values = np.asarray(series, dtype=float)
+        valid = ~np.isnan(values)
+        codes = pd.factorize(np.asarray(clusters)[valid])[0]
+        missing = codes < 0
+        codes[missing] = codes.max(initial=-1) + 1 + np.arange(missing.sum())
+        return np.bincount(codes, weights=values[valid]), np.bincount(codes).astype(float)
+
+    def _draw_cluster_weights(self, n_clusters: int, n_iter: int, method: str = "poisson") -> np.array:
+        """
+        Draws the bootstrap weight of every cluster for n_iter replicates. "multinomial" is the classic
+        bootstrap (n_clusters draws with replacement) and "poisson" its Poisson(1) approximation, which
+        doesn't need the total and is cheaper to draw.
+
+        Returns:
+            weights (np.array): (n_iter, n_clusters) array with the number of times each cluster is drawn
+        """
+        if method == "poisson":
+            return self.nrg.poisson(1.0, size=(n_iter, n_clusters)).astype(float)
+        if method == "multinomial":
+            return self.nrg.multinomial(n_clusters, np.full(n_clusters, 1 / n_clusters), size=n_iter).astype(float)
+        raise Exception('Method is not supported. Choose one of "poisson" or "multinomial"')
+
+    def generate_cluster_mean_replicates(
+        self, 
+        series: pd.Series, 
+        clusters: pd.Series, 
+        n_iter: int = 1000, 
+        method: str = "poisson",
+        max_batch_cells: int = 2 ** 24
+        ) -> np.array:
+        """
+        Cluster bootstrap of the mean of series: clusters, not rows, are resampled, which is the right unit when
+        the randomization is by cluster. Rows are never duplicated: the per-cluster sums and counts are computed 
+        once and each replicate is a weighted reduction over them, mean* = sum(w * sums) / sum(w * counts), so the
+        cost scales with the number of clusters and not with the number of rows. The replicates are drawn in 
+        batches of at most max_batch_cells weights to bound the memory.
+
+        With "poisson" a replicate can draw no cluster at all (likely when there are few clusters), which has no
+        mean. The weights of those replicates are redrawn, i.e. replicates are conditioned on a non-empty sample.
+
+        Args:
+            series (pd.Series): Values of the chosen variable, one per row
+            clusters (pd.Series): Cluster of each row
+            n_iter (int): Number of bootstrap replicates
+            method (str): Distribution of the cluster weights, "poisson" or "multinomial"
+            max_batch_cells (int): Maximum size of a batch of weights
+
+        Returns:
+            replicates (np.array): The n_iter bootstrapped means
+        """
+        sums, counts = self.aggregate_clusters(series, clusters)
+        if len(sums) == 0:
+            raise Exception('There are no values to bootstrap')
+        aggregates = np.column_stack([sums, counts])
+        batch_size = max(1, max_batch_cells // len(sums))
+
+        replicates = []
+        for start in range(0, n_iter, batch_size):
+            weights = self._draw_cluster_weights(len(sums), min(batch_size, n_iter - start), method)
+            empty = weights.sum(axis=1) == 0
+            while empty.any():
+                weights[empty] = self._draw_cluster_weights(len(sums), empty.sum(), method)
+                empty = weights.sum(axis=1) == 0
+            weighted_sums, weighted_counts = (weights @ aggregates).T
+            replicates.append(weighted_sums / weighted_counts)
+        return np.concatenate(replicates)
+
+    @classmethod
+    def summarize_quantile_replicates(
+        cls, 
+        control_q: np.array, 
+        variant_q: np.array, 
+        q: np.array, 
+        ci: float = 95
+        ) -> pd.DataFrame:
+        """
+        Same summary as summarize_quantile_effect but computed straight from the (n_iter, len(q)) replicate 
+        matrices with vectorized reductions. It's cheap enough to be called on every change of the CI level.
+
+        Args:
+            control_q (np.array): (n_iter, len(q)) array with the bootstrapped quantiles of control
+            variant_q (np.array): (n_iter, len(q)) array with the bootstrapped quantiles of variant
+            q (np.array): the quantiles of the columns of the matrices
+            ci (float): Confidence level of the interval, in percent
+
+        Returns:
+            data (pd.DataFrame): Dataframe with the scheme of summarize_quantile_effect
+        """
+        diff = variant_q - control_q
+        diff_lower, diff_upper = cls.generate_ci_interval(diff, ci)
+        data = pd.DataFrame({
+            "percentiles": q,
+            "variant_mean": variant_q.mean(axis=0),
+            "control_mean": control_q.mean(axis=0),
+            "diff_mean": diff.mean(axis=0),
+            "diff_lower": diff_lower,
+            "diff_upper": diff_upper
+        })
+        data["plot_axis"] = [f'{p:.2f} | {m:,.0f}' for p, m in zip(data["percentiles"], data["variant_mean"])]
+        return data
+
 
     def generate_quantile_clean(self):
         # TODO -> Add Docstring
@@ -94,8 +321,20 @@ class Bootstrapper:
         # TODO -> Complete. This function is a wrapper that combines generate_quantile_bootstrap_raw and summarize_quantile_effect
         pass
 
-    def generate_ci_interval(self, ci=95):
-        # TODO -> Add Docstring
-        # TODO -> Add Typing
-        # TODO -> Complete. This function takes a series and compute the CI intervals
-        pass
+    @staticmethod
+    def generate_ci_interval(replicates: np.array, ci: float = 95) -> Tuple[np.array, np.array]:
+        """
+        Percentile confidence interval of bootstrap replicates.
+
+        Args:
+            replicates (np.array): Replicates of a statistic. If it's a matrix, the rows are the replicates and 
+            one interval is computed per column.
+            ci (float): Confidence level of the interval, in percent
+
+        Returns:
+            lower (np.array): Lower bound of the interval
+            upper (np.array): Upper bound of the interval
+        """
+        tail = (100 - ci) / 2
+        lower, upper = np.percentile(replicates, [tail, 100 - tail], axis=0)
+        return lower, upper
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+
+class ColumnCache:
+    """
+    The ColumnCache class persists the parsed columns of a test as binary .npy files in a local directory so
+    reruns, new sessions and worker processes map them with np.load(mmap_mode='r') instead of parsing the
+    csv again. Entries are keyed by a content hash of the source file and the columns are stored per variant,
+    so the series used by the engines are read zero-copy from the page cache. The original row of every value
+    and the null mask of the string columns are stored too, so load_frame gives back the parsed data as it was.
+    Only data that round-trips exactly is cached: numeric and boolean columns, and object columns that hold
+    nothing but strings and missing values. Anything else (e.g. a True/False flag with blanks, which pandas
+    parses as an object column of bools) is not stored and is parsed on every load.
+
+    Layout of an entry:
+        <cache_dir>/<key>/manifest.json            -> variants, columns and dtypes
+        <cache_dir>/<key>/<variant>/rows.npy       -> original row of each value of the variant
+        <cache_dir>/<key>/<variant>/<col>.npy      -> one array per variant and column
+        <cache_dir>/<key>/<variant>/<col>.mask.npy -> null mask of the string columns with missing values
+
+    The cache is bounded in size: when it grows over max_bytes the least recently used entries are evicted.
+
+    Attributes:
+        cache_dir (str): Directory of the cache. By default ~/.cache/signf_app
+        max_bytes (int): Maximum size of the cache in bytes. Set to 5GB by default.
+    """
+
+    MANIFEST = "manifest.json"
+    FINGERPRINTS = ".fingerprints.json"
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = 5 * 1024 ** 3) -> None:
+        self.cache_dir = cache_dir or os.path.join(os.path.expanduser("~"), ".cache", "signf_app")
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _hash(f, chunksize: int = 1024 ** 2) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        for chunk in iter(lambda: f.read(chunksize), b""):
+            digest.update(chunk if isinstance(chunk, bytes) else chunk.encode())
+        return digest.hexdigest()
+
+    def fingerprint(self, source) -> str:
+        """
+        Content hash of a file. It accepts either a path or a file-like object such as the one returned
+        by the Streamlit file uploader, which is rewound after reading. The hash of a path is remembered
+        by (path, size, modification time) so reopening an unchanged file doesn't read it again.
+        """
+        if hasattr(source, "read"):
+            source.seek(0)
+            key = self._hash(source)
+            source.seek(0)
+            return key
+
+        stat = os.stat(source)
+        file_id = f"{os.path.realpath(source)}|{stat.st_size}|{stat.st_mtime_ns}"
+        index_path = os.path.join(self.cache_dir, self.FINGERPRINTS)
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+
+        if file_id not in index:
+            with open(source, "rb") as f:
+                index[file_id] = self._hash(f)
+            tmp_path = f"{index_path}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+        return index[file_id]
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def has(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self._entry(key), self.MANIFEST))
+
+    @staticmethod
+    def is_storable(values: np.array) -> bool:
+        """
+        Whether a column round-trips exactly through a .npy file: any non object array does, and an object
+        array does only if its values are strings or missing, which are stored as fixed width strings.
+        """
+        return values.dtype != object or pd.api.types.infer_dtype(values, skipna=True) in ("string", "empty")
+
+    def store(self, key: str, data: pd.DataFrame) -> bool:
+        """
+        Persists every column of data split by variant. String columns are stored as fixed width strings
+        along with their null mask. The entry is written in a temporary directory and renamed, so concurrent
+        readers never see it half written. The new entry is never evicted by its own store.
+
+        Args:
+            key (str): Key of the entry, usually the fingerprint of the source file
+            data (pd.DataFrame): Parsed test data. It must have a "variant" column.
+
+        Returns:
+            stored (bool): Whether the entry is in the cache. It's False when some column is not storable,
+            see is_storable.
+        """
+        if self.has(key):
+            return True
+
+        if not all(self.is_storable(data[col].to_numpy()) for col in data.columns):
+            return False
+
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp-")
+        columns = [c for c in data.columns if c != "variant"]
+        manifest = {
+            "variants": [],
+            "columns": columns,
+            "order": list(data.columns),
+            "dtypes": [str(data[c].dtype) for c in columns],
+            "variant_dtype": str(data["variant"].dtype),
+            "n_rows": len(data)
+        }
+        rows = np.arange(len(data))
+        for i, (variant, group) in enumerate(data.groupby("variant", sort=True, dropna=False)):
+            # Variants are stored by position so any label is a valid directory name
+            variant_dir = os.path.join(tmp_dir, str(i))
+            os.makedirs(variant_dir)
+            manifest["variants"].append(None if pd.isna(variant) else variant)
+            np.save(os.path.join(variant_dir, "rows.npy"), rows[data.index.get_indexer(group.index)])
+            for j, col in enumerate(columns):
+                values = group[col].to_numpy()
+                if values.dtype == object:
+                    mask = pd.isna(values)
+                    values = np.where(mask, "", values).astype(str)
+                    if mask.any():
+                        np.save(os.path.join(variant_dir, f"{j}.mask.npy"), mask)
+                np.save(os.path.join(variant_dir, f"{j}.npy"), values)
+
+        with open(os.path.join(tmp_dir, self.MANIFEST), "w") as f:
+            json.dump(manifest, f, default=str)
+
+        try:
+            os.rename(tmp_dir, self._entry(key))
+        except OSError:
+            # Another process stored the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict(keep=key)
+        return True
+
+    def _manifest(self, key: str) -> dict:
+        path = os.path.join(self._entry(key), self.MANIFEST)
+        with open(path) as f:
+            manifest = json.load(f)
+        # Mark the entry as recently used for the eviction
+        os.utime(path)
+        return manifest
+
+    @staticmethod
+    def _load_column(variant_dir: str, j: int) -> np.array:
+        """
+        Maps a stored column. String columns with missing values get them back, which requires a copy.
+        """
+        values = np.load(os.path.join(variant_dir, f"{j}.npy"), mmap_mode="r")
+        mask_path = os.path.join(variant_dir, f"{j}.mask.npy")
+        if os.path.exists(mask_path):
+            values = values.astype(object)
+            values[np.load(mask_path)] = np.nan
+        return values
+
+    def load_columns(self, key: str) -> Dict[str, Dict[str, np.memmap]]:
+        """
+        Maps the columns of an entry without copying them.
+
+        Args:
+            key (str): Key of the entry
+
+        Returns:
+            columns (dict): For each variant, a dict with the memory-mapped array of each column
+        """
+        manifest = self._manifest(key)
+        return {
+            variant: {
+                col: self._load_column(os.path.join(self._entry(key), str(i)), j)
+                for j, col in enumerate(manifest["columns"])
+            }
+            for i, variant in enumerate(manifest["variants"])
+        }
+
+    def load_frame(self, key: str) -> pd.DataFrame:
+        """
+        Rebuilds the test data of an entry as a DataFrame with the rows, columns and dtypes of the source.
+        """
+        manifest = self._manifest(key)
+        n_rows, columns = manifest["n_rows"], manifest["columns"]
+        rows = [np.load(os.path.join(self._entry(key), str(i), "rows.npy")) for i in range(len(manifest["variants"]))]
+
+        data = {"variant": np.empty(n_rows, dtype=object)}
+        for i, variant in enumerate(manifest["variants"]):
+            data["variant"][rows[i]] = np.nan if variant is None else variant
+
+        for j, (col, dtype) in enumerate(zip(columns, manifest["dtypes"])):
+            parts = [self._load_column(os.path.join(self._entry(key), str(i)), j) for i in range(len(rows))]
+            values = np.empty(n_rows, dtype=np.result_type(*parts) if parts else object)
+            for i, part in enumerate(parts):
+                values[rows[i]] = part
+            data[col] = values
+
+        frame = pd.DataFrame({col: data[col] for col in manifest["order"]})
+        dtypes = dict(zip(columns, manifest["dtypes"]), variant=manifest.get("variant_dtype"))
+        for col in frame.columns:
+            if frame[col].dtype == object and dtypes.get(col) not in (None, "object"):
+                frame[col] = frame[col].astype(dtypes[col])
+        return frame
+
+    def _entries(self) -> List[str]:
+        return [
+            key for key in os.listdir(self.cache_dir)
+            if not key.startswith(".") and self.has(key)
+        ]
+
+    def _size(self, key: str) -> int:
+        size = 0
+        for root, _, files in os.walk(self._entry(key)):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        return size
+
+    def evict(self, keep: str = None) -> None:
+        """
+        Removes the least recently used entries until the cache fits in max_bytes. The entry keep, e.g. the
+        one just stored, is never removed even if it doesn't fit on its own.
+        """
+        entries = sorted(
+            [key for key in self._entries() if key != keep],
+            key=lambda key: os.path.getmtime(os.path.join(self._entry(key), self.MANIFEST))
+        )
+        sizes = {key: self._size(key) for key in entries}
+        total = sum(sizes.values()) + (self._size(keep) if keep is not None and self.has(keep) else 0)
+        for key in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= sizes[key]
@@ -1,9 +1,9 @@
 
-from scipy.stats import chisquare
-from statsmodels.stats.power import TTestPower, NormalIndPower
-from statsmodels.stats.proportion import proportion_effectsize
 import numpy as np
 
+# scipy and statsmodels are imported on first use. They are the slowest dependencies to import,
+# so headless and batch runs that only import the package don't pay for them.
+
 
 class Checker:
     # TODO -> Add Logger
@@ -19,6 +19,8 @@ class Checker:
 
     def _do_chi(self, obs, exp):
         # TODO add docstring
+        from scipy.stats import chisquare
+
         chi = chisquare(f_obs = obs, f_exp= exp)
         return  chi[1]
 
@@ -34,11 +36,16 @@ class Checker:
     def calculate_power_for_mean(self, control, variant):
         # TODO add docstring
         # print(control.mean(), variant.mean())
+        from statsmodels.stats.power import TTestPower
+
         treatment_effect = np.abs(control.mean() - variant.mean())
         control_std = control.std()
         return TTestPower().power(effect_size=treatment_effect/control_std, nobs=len(control), alpha=self.alpha)
 
 
     def calculate_power_for_proportion(self, control, variant, nobs):
+        from statsmodels.stats.power import NormalIndPower
+        from statsmodels.stats.proportion import proportion_effectsize
+
         effect_size = proportion_effectsize(control, variant)
         return NormalIndPower().power(effect_size, nobs1=nobs, alpha=self.alpha)
@@ -1,4 +1,8 @@
 from enum import Enum
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
 
 
 def sort_dictionary_by_key(dict_to_sort):
@@ -6,6 +10,30 @@ def sort_dictionary_by_key(dict_to_sort):
     # TODO -> Add Typing
     return {key:dict_to_sort[key] for key in sorted(dict_to_sort.keys())}
 
+
+def get_strata_layout(strata: np.array) -> Tuple[np.array, np.array, np.array, np.array]:
+    """
+    Build a sort-by-stratum layout so the resampling engines can work on contiguous segments
+    instead of looping over each stratum in Python.
+
+    Args:
+        strata (np.array): Stratum label of each row (day, country, platform...). Rows with a missing
+        label are one more stratum.
+
+    Returns:
+        order (np.array): Stable argsort that groups the rows by stratum
+        codes (np.array): Integer stratum code of each row, already in sorted order
+        starts (np.array): Position where each stratum segment starts in the sorted layout
+        counts (np.array): Number of rows in each stratum segment
+    """
+    codes = pd.factorize(np.asarray(strata), use_na_sentinel=False)[0]
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    counts = np.bincount(codes)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return order, codes, starts, counts
+
+
 class VarTypes(Enum):
     PROPORTION = "proportion"
     CONTINUOUS = "continuous"
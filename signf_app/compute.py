@@ -0,0 +1,97 @@
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Hashable
+
+
+class ComputeService:
+    """
+    The ComputeService class is a shared job queue to run the heavy analyses of the app once per server instead
+    of once per session. It has three pieces:
+        - A bounded worker pool: at most max_workers jobs run at the same time, the rest wait in the queue.
+        - Single-flight de-duplication: a job is identified by a key, e.g. the fingerprint of the data and the
+        parameters of the analysis. A request for a key that is already queued or running attaches to that job
+        and gets the same Future, so identical analyses are computed only once.
+        - Fair scheduling: every session has its own queue and the free workers take jobs from the sessions in
+        round-robin, so one session launching many analyses doesn't starve the others.
+
+    Numpy releases the GIL in the heavy loops, so threads are enough to use several cores.
+
+    Attributes:
+        max_workers (int): Maximum number of jobs running at the same time. Set to 2 by default.
+        max_pending (int): Maximum number of jobs waiting in the queue. No limit by default.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = None) -> None:
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="signf-compute")
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, Future] = {}
+        self._queues: "OrderedDict[Hashable, deque]" = OrderedDict()
+        self._running = 0
+        self._pending = 0
+
+    def submit(self, session_id: Hashable, key: Hashable, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Submits a job or attaches to the identical one already queued or running.
+
+        Args:
+            session_id (Hashable): Identifier of the session submitting the job, used for the fair scheduling
+            key (Hashable): Identifier of the job. Jobs with the same key must produce the same result.
+            fn (Callable): Function to run, called with args and kwargs
+
+        Returns:
+            future (Future): Future with the result of the job
+        """
+        with self._lock:
+            if key in self._in_flight:
+                return self._in_flight[key]
+
+            if self.max_pending is not None and self._pending >= self.max_pending:
+                raise Exception('Compute service is at capacity. Try again later')
+
+            future = Future()
+            self._in_flight[key] = future
+            self._queues.setdefault(session_id, deque()).append((key, future, fn, args, kwargs))
+            self._pending += 1
+            self._dispatch()
+        return future
+
+    def run(self, session_id: Hashable, key: Hashable, fn: Callable, *args, **kwargs):
+        """
+        Same as submit but waits for the job and returns its result.
+        """
+        return self.submit(session_id, key, fn, *args, **kwargs).result()
+
+    def _dispatch(self) -> None:
+        """
+        Starts queued jobs while there are free workers, taking one job per session in turns.
+        It must be called holding the lock.
+        """
+        while self._running < self.max_workers and self._queues:
+            session_id, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            # The session goes to the end of the round
+            del self._queues[session_id]
+            if queue:
+                self._queues[session_id] = queue
+
+            self._pending -= 1
+            self._running += 1
+            self._executor.submit(self._run_job, *job)
+
+    def _run_job(self, key: Hashable, future: Future, fn: Callable, args: tuple, kwargs: dict) -> None:
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        with self._lock:
+            del self._in_flight[key]
+            self._running -= 1
+            self._dispatch()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
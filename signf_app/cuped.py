@@ -0,0 +1,82 @@
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class Cuped:
+    """
+    The Cuped class implements CUPED (Controlled-experiment Using Pre-Experiment Data) variance reduction.
+    Each metric Y is adjusted with a pre-period covariate X, usually the same metric before the test:
+
+        Y_cuped = Y - theta * (X - mean(X)),   theta = cov(Y, X) / var(X)
+
+    The adjusted metric has the same mean as Y and its variance is reduced by corr(Y, X)^2, so the same
+    decisions need less data and fewer replicates. theta is estimated on the pooled data of all the variants,
+    which keeps the estimator of the treatment effect unbiased.
+
+    All the metrics are adjusted at once: the covariances come from a single pass of pooled sufficient
+    statistics (sums, sums of squares and cross products) over (n_rows, n_metrics) arrays. Missing covariate
+    values are replaced by the covariate mean, i.e. those rows are not adjusted.
+
+    Reference: Deng, Xu, Kohavi, Walker. Improving the Sensitivity of Online Controlled Experiments by
+    Utilizing Pre-Experiment Data (https://exp-platform.com/Documents/2013-02-CUPED-ImprovingSensitivityOfControlledExperiments.pdf)
+    """
+
+    @staticmethod
+    def estimate_theta(y: np.array, x: np.array) -> Tuple[np.array, np.array]:
+        """
+        Estimates theta and the variance reduction of each column from pooled sufficient statistics.
+
+        Args:
+            y (np.array): (n_rows, n_metrics) array with the metrics. Missing values are ignored.
+            x (np.array): (n_rows, n_metrics) array with the covariate of each metric, without missing values
+
+        Returns:
+            theta (np.array): Adjustment coefficient of each metric
+            variance_reduction (np.array): Share of the variance removed from each metric, corr(Y, X)^2
+        """
+        valid = ~np.isnan(y)
+        n = valid.sum(axis=0)
+        x, y = np.where(valid, x, 0.0), np.where(valid, y, 0.0)
+        sum_x, sum_y = x.sum(axis=0), y.sum(axis=0)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sxx = np.einsum("ij,ij->j", x, x) - sum_x ** 2 / n
+            syy = np.einsum("ij,ij->j", y, y) - sum_y ** 2 / n
+            sxy = np.einsum("ij,ij->j", x, y) - sum_x * sum_y / n
+            theta = np.where(sxx > 0, sxy / sxx, 0.0)
+            variance_reduction = np.where((sxx > 0) & (syy > 0), sxy ** 2 / (sxx * syy), 0.0)
+        return theta, variance_reduction
+
+    @classmethod
+    def adjust(cls, data: pd.DataFrame, covariates: Dict[str, str]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Adjusts several metrics with their pre-period covariates in one vectorized operation.
+
+        Args:
+            data (pd.DataFrame): DataFrame with the raw data of all the variants
+            covariates (dict): Covariate column of each metric, e.g. {"revenue": "revenue_pre"}
+
+        Returns:
+            data (pd.DataFrame): Copy of data where each metric is replaced by its adjusted values
+            summary (pd.DataFrame): theta and the variance reduction of each metric
+        """
+        metrics = list(covariates)
+        missing = [c for c in metrics + list(covariates.values()) if c not in data.columns]
+        if missing:
+            raise Exception(f'Columns are not in dataframe: {", ".join(missing)}')
+
+        y = data[metrics].to_numpy(dtype=float)
+        x = data[list(covariates.values())].to_numpy(dtype=float)
+        x_mean = np.nanmean(x, axis=0)
+        x = np.where(np.isnan(x), x_mean, x)
+
+        theta, variance_reduction = cls.estimate_theta(y, x)
+        adjusted = y - theta * (x - x_mean)
+
+        summary = pd.DataFrame(
+            {"covariate": list(covariates.values()), "theta": theta, "variance_reduction": variance_reduction},
+            index=pd.Index(metrics, name="metric")
+        )
+        return data.assign(**dict(zip(metrics, adjusted.T))), summary
@@ -1,5 +1,10 @@
+import numpy as np
 import pandas as pd
-from typing import Tuple 
+from typing import Dict, Iterator, List, Tuple 
+
+from signf_app.cache import ColumnCache
+from signf_app.sketch import QuantileSketch
+from signf_app.sql import SQLSource, BigQuerySource
 
 
 class Loader:
@@ -7,12 +12,227 @@ class Loader:
     # TODO -> Should I create a Transformer class?
     """
     The objective of this class is have the functions required to succesfully load
-    the test data into the app
+    the test data into the app. If a ColumnCache is given, the parsed columns are persisted
+    on the first load and later loads map them instead of parsing the file again.
+
+    The test data can also live in a database behind a sql.SQLSource (BigQuery by default, or any
+    DB-API connection such as SQLite/DuckDB). The query_* methods push the aggregations into the
+    database so only compact aggregates are fetched; the raw rows are streamed in batches only
+    when an engine needs them.
     """
+
+    def __init__(self, cache: ColumnCache = None, source: SQLSource = None) -> None:
+        self.cache = cache
+        self.source = source
+
+    def auth(self, project: str = None) -> None:
+        """
+        Sets BigQuery as the SQL source if none was given. The credentials are requested on the
+        first query, so calling it doesn't trigger the authentication flow for csv files.
+        """
+        if self.source is None:
+            self.source = BigQuerySource(project)
+
+    def load_test_data(self, path: str, format: str = "sql") -> pd.DataFrame:
+        """
+        Loads the raw test data, either from a csv or from the SQL source.
+
+        Args:
+            path (str): Path or file-like object of the csv, or table name or SELECT query for sql
+            format (str): "csv" or "sql"
+
+        Returns:
+            data (pd.DataFrame): The test data
+        """
+        if format == "csv":
+            return self.load_data(path)
+
+        if format == "sql":
+            batches = list(self.iter_test_data(path))
+            return pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
+
+        raise Exception('Format is not supported. Choose one of "csv" or "sql"')
+
+    def _get_source(self) -> SQLSource:
+        if self.source is None:
+            raise Exception('Loader has no SQL source. Pass one or call auth()')
+        return self.source
+
+    @staticmethod
+    def _relation(table: str) -> str:
+        # A SELECT query is used as a subquery, anything else as a table name
+        if table.lstrip().lower().startswith(("select", "with")):
+            return f"({table}) AS test_data"
+        return table
+
+    def iter_test_data(self, table: str, columns: List[str] = None, batch_size: int = 100_000) -> Iterator[pd.DataFrame]:
+        """
+        Streams the raw rows of the test data in batches of at most batch_size rows.
+
+        Args:
+            table (str): Table name or SELECT query with the test data
+            columns (list): Columns to fetch. All of them by default.
+            batch_size (int): Number of rows per batch
+        """
+        source = self._get_source()
+        select = ", ".join(source.quote(c) for c in columns) if columns else "*"
+        yield from source.iter_batches(f"SELECT {select} FROM {self._relation(table)}", batch_size)
+
+    def query_sufficient_statistics(self, table: str, varnames: List[str]) -> pd.DataFrame:
+        """
+        Same as sufficient_statistics but computed in the database: one GROUP BY over the variants
+        returns the count, sum and sum of squares of every variable.
+
+        Args:
+            table (str): Table name or SELECT query with the test data
+            varnames (list): Variables to aggregate
+
+        Returns:
+            stats (pd.DataFrame): One row per variant, control first, and the columns (var, "n"), (var, "sum")
+            and (var, "sum_sq") for each variable
+        """
+        source = self._get_source()
+        aggregates = []
+        for i, var in enumerate(varnames):
+            col = f"(1.0 * {source.quote(var)})"
+            aggregates += [f"COUNT({col}) AS n_{i}", f"SUM({col}) AS sum_{i}", f"SUM({col} * {col}) AS sum_sq_{i}"]
+        variant = source.quote("variant")
+        result = source.query(
+            f"SELECT {variant} AS variant, {', '.join(aggregates)} FROM {self._relation(table)} GROUP BY {variant}"
+        ).set_index("variant")
+
+        stats = pd.concat(
+            {
+                (var, stat): result[f"{stat}_{i}"].astype(float).fillna(0)
+                for i, var in enumerate(varnames)
+                for stat in ("n", "sum", "sum_sq")
+            },
+            axis=1
+        )
+        variants = sorted(stats.index, key=lambda v: (v != "Control", v))
+        return stats.loc[variants]
+
+    def query_value_counts(self, table: str, varname: str) -> pd.DataFrame:
+        """
+        Frequency table of a variable per variant computed in the database. For discrete metrics
+        it's a lossless summary of the data.
+
+        Returns:
+            counts (pd.DataFrame): The columns variant, value and count
+        """
+        source = self._get_source()
+        variant, col = source.quote("variant"), source.quote(varname)
+        return source.query(
+            f"SELECT {variant} AS variant, {col} AS value, COUNT(*) AS count "
+            f"FROM {self._relation(table)} WHERE {col} IS NOT NULL GROUP BY {variant}, {col}"
+        ).sort_values(["variant", "value"], ignore_index=True)
+
+    def query_histogram(
+        self, 
+        table: str, 
+        varname: str, 
+        bins: int = 50, 
+        hist_range: Tuple[float, float] = None
+        ) -> pd.DataFrame:
+        """
+        Histogram of a variable per variant computed in the database, with bins shared by all the variants.
+
+        Args:
+            table (str): Table name or SELECT query with the test data
+            varname (str): Variable of the histogram
+            bins (int): Number of bins of equal width
+            hist_range (float, float): (start, end) of the bins. By default the min and max of the variable.
+            Values out of the range are dropped.
+
+        Returns:
+            histogram (pd.DataFrame): The columns variant, bin, bin_start, bin_end and count. Empty when the
+            variable has no values in the range, e.g. when it's entirely NULL.
+        """
+        columns = ["variant", "bin", "bin_start", "bin_end", "count"]
+        source = self._get_source()
+        variant, col = source.quote("variant"), source.quote(varname)
+        relation = self._relation(table)
+        if hist_range is None:
+            hist_range = tuple(source.query(f"SELECT MIN({col}) AS lo, MAX({col}) AS hi FROM {relation}").iloc[0])
+        if pd.isna(hist_range[0]) and pd.isna(hist_range[1]):
+            return pd.DataFrame(columns=columns)
+        lo, hi = float(hist_range[0]), float(hist_range[1])
+        width = (hi - lo) / bins if hi > lo else 1.0
+
+        histogram = source.query(
+            f"SELECT {variant} AS variant, {source.floor(f'((1.0 * {col}) - {lo!r}) / {width!r}')} AS bin, COUNT(*) AS count "
+            f"FROM {relation} WHERE {col} >= {lo!r} AND {col} <= {hi!r} GROUP BY 1, 2"
+        )
+        # The max falls on the right edge of the last bin
+        histogram["bin"] = histogram["bin"].astype(int).clip(upper=bins - 1)
+        histogram = histogram.groupby(["variant", "bin"], as_index=False)["count"].sum()
+        return histogram.assign(
+            bin_start=lo + histogram["bin"] * width,
+            bin_end=lo + (histogram["bin"] + 1) * width
+        )[columns]
     
     def load_data(self, path: str) -> pd.DataFrame:
         # TODO -> Add Docstring
+        if self.cache is None:
             return pd.read_csv(path)
+
+        key = self.cache.fingerprint(path)
+        if self.cache.has(key):
+            try:
+                return self.cache.load_frame(key)
+            except FileNotFoundError:
+                # The entry was evicted by another process in the meantime
+                pass
+
+        data = pd.read_csv(path)
+        self.cache.store(key, data)
+        return data
+
+    def load_columns(self, path: str) -> Dict[str, Dict[str, np.memmap]]:
+        """
+        Returns the memory-mapped columns of the test data per variant, parsing and caching the file
+        only if it's not in the cache yet. Worker processes can call it to share the data zero-copy.
+
+        Args:
+            path (str): Path or file-like object of the csv with the test data
+
+        Returns:
+            columns (dict): For each variant, a dict with the memory-mapped array of each column
+        """
+        if self.cache is None:
+            raise Exception('Loader was created without a cache')
+
+        key = self.cache.fingerprint(path)
+        if not self.cache.has(key) and not self.cache.store(key, pd.read_csv(path)):
+            raise Exception('Test data has columns that cannot be cached, e.g. object columns that are not strings')
+        return self.cache.load_columns(key)
+
+    def sketch_data(
+        self, 
+        path: str, 
+        varname: str, 
+        chunksize: int = 1_000_000, 
+        rank_error: float = 0.01
+        ) -> Dict[str, QuantileSketch]:
+        """
+        Summarizes a variable per variant in one streaming pass over the csv, without loading it in memory.
+        Each chunk is sketched per variant and merged into the running sketches, so the memory is bounded
+        by the chunksize and the size of the sketches.
+
+        Args:
+            path (str): Path of the csv with the test data
+            varname (str): Variable to summarize
+            chunksize (int): Number of rows read at once
+            rank_error (float): Target rank error of the sketches
+
+        Returns:
+            sketches (dict): A quantile sketch of varname for each variant
+        """
+        sketches = {}
+        for chunk in pd.read_csv(path, usecols=["variant", varname], chunksize=chunksize):
+            for variant, values in chunk.groupby("variant")[varname]:
+                sketches.setdefault(variant, QuantileSketch(rank_error)).update(values)
+        return sketches
         
 
     @staticmethod
@@ -51,6 +271,35 @@ class Loader:
                     )
 
 
+    @staticmethod
+    def sufficient_statistics(data: pd.DataFrame, varnames: List[str]) -> pd.DataFrame:
+        """
+        Computes the sufficient statistics of several variables per variant in one grouped reduction.
+        Missing values are ignored.
+
+        Args:
+            data (pd.DataFrame): DataFrame with the raw data
+            varnames (list): Variables to aggregate
+
+        Returns:
+            stats (pd.DataFrame): One row per variant, control first, and the columns (var, "n"), (var, "sum")
+            and (var, "sum_sq") for each variable
+        """
+        values = data[varnames]
+        grouped = pd.concat([values, values.pow(2).add_suffix("__sq")], axis=1).groupby(data["variant"])
+        sums, counts = grouped.sum(), grouped.count()
+        stats = pd.concat(
+            {
+                "n": counts[varnames],
+                "sum": sums[varnames],
+                "sum_sq": sums[[f"{v}__sq" for v in varnames]].set_axis(varnames, axis=1)
+            },
+            axis=1
+        ).swaplevel(axis=1)[pd.MultiIndex.from_product([varnames, ["n", "sum", "sum_sq"]])]
+        variants = sorted(stats.index, key=lambda v: (v != "Control", v))
+        return stats.loc[variants]
+
+
     def aggregate_by_user():
         # TODO -> Add Docstring
         pass
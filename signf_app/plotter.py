@@ -2,19 +2,24 @@ from typing import Tuple, Union
 
 import numpy as np
 import pandas as pd
-import plotly.graph_objects as go
 
 from signf_app.loader import Loader
+from signf_app.sketch import QuantileSketch
 
 
 class PlotlyBackend:
     """
     This class contains method to produce the required plot for analysis using Plotly as 
-    backend.
+    backend. Plotly is imported on first use so headless runs don't pay for it.
     """
     
     @staticmethod
-    def make_hist(control: pd.Series, variant: pd.Series, figsize: Tuple[int,int] = (800,600) ):
+    def make_hist(
+        control: pd.Series, 
+        variant: pd.Series, 
+        figsize: Tuple[int,int] = (800,600), 
+        hist_range: Tuple[float, float] = None
+        ):
         """
         Produce an histogram for both control and variant.
 
@@ -22,14 +27,18 @@ class PlotlyBackend:
             control (pd.Series) -> Array containing the values of the chosen variable in the control group
             variant (pd.Series) -> Array containing the values of the chosen variable in the variant group
             figsize (int, int) : A (width, height)  tuple in pixels that specifies the size of the returned figure
+            hist_range (float, float) : Optional (start, end) of the bins, shared by both histograms
 
         Returns
             f: A Figure that contains the histograms of both control and variant  
         """
         w,h = figsize
+        import plotly.graph_objects as go
+
+        xbins = dict(start=hist_range[0], end=hist_range[1]) if hist_range else None
         f = go.Figure()
-        f.add_trace(go.Histogram(x=control, name="Control"))
-        f.add_trace(go.Histogram(x=variant, name="Variant"))
+        f.add_trace(go.Histogram(x=control, name="Control", xbins=xbins))
+        f.add_trace(go.Histogram(x=variant, name="Variant", xbins=xbins))
         f.update_layout(
             barmode="overlay",
             title='Histogram of both variant and control',
@@ -39,7 +48,7 @@ class PlotlyBackend:
         return f
 
     @staticmethod
-    def make_quantile(data: pd.DataFrame, varname: str, figsize: Tuple[int,int] = (800,600) ):
+    def make_quantile(data: pd.DataFrame, varname: str, figsize: Tuple[int,int] = (800,600), ci: float = 95):
         """
         Produce an quantile treatment plot. It already asume the scheme of the input dataframe to plot the figure which 
         comes from bootstrapper.Bootstrapper.summarize_quantile_effect. 
@@ -48,15 +57,18 @@ class PlotlyBackend:
             data (pd.DataFrame): Dataframe with the expected scheme
             varname (str) : Chosen variable. This variable is just to use it in the title.
             figsize (int, int) : A (width, height)  tuple in pixels that specifies the size of the returned figure
+            ci (float) : Confidence level of the intervals, used just in the legend.
 
         Returns
             f: Figure object. 
 
         """
+        import plotly.graph_objects as go
+
         w,h = figsize
         f = go.Figure()
-        f.add_trace(go.Scatter(y=data["diff_lower"], x=data["plot_axis"], name="Lower Bound 95CI"))
-        f.add_trace(go.Scatter(y=data["diff_upper"], x=data["plot_axis"], fill="tonexty", name="Upper Bound 95CI"))
+        f.add_trace(go.Scatter(y=data["diff_lower"], x=data["plot_axis"], name=f"Lower Bound {ci:g}CI"))
+        f.add_trace(go.Scatter(y=data["diff_upper"], x=data["plot_axis"], fill="tonexty", name=f"Upper Bound {ci:g}CI"))
         f.add_trace(go.Scatter(y=data["diff_mean"], x=data["plot_axis"], mode="lines", name="Mean"))
         f.add_hline(y=0)
         f.update_layout(
@@ -91,6 +103,8 @@ class PlotlyBackend:
         """
 
         # TODO -> Add figsize parameter to plotly -> DONE
+        import plotly.graph_objects as go
+
         w,h = figsize
         f = go.Figure()
         f.add_trace(go.Histogram(x=modeled_h0, name="H0"))
@@ -110,16 +124,35 @@ class PlotlyBackend:
 class Plotter:
     """
     This class is the one used to call the method that generates the plot for analysis.
-    It's also wrapper to have both the Plotly and Pyplot backend availables. 
+    It's also wrapper to have both the Plotly and Pyplot backend availables. The backends are
+    looked up by name in a registry, new ones are added with register_backend. A backend is any
+    class implementing make_hist, make_quantile and make_h0_hist like PlotlyBackend.
     """
+
+    _backends = {"plotly": PlotlyBackend}
+
+    @classmethod
+    def register_backend(cls, name: str, backend) -> None:
+        """
+        Register a plot backend under name so it can be chosen with the backend argument.
+        """
+        cls._backends[name] = backend
+
+    @classmethod
+    def get_backend(cls, name: str):
+        if name not in cls._backends:
+            raise Exception(f'Plot backend is not supported. Choose one of {", ".join(cls._backends)}')
+        return cls._backends[name]
      
-    @staticmethod
+    @classmethod
     def plot_hist(
+        cls,
         data: pd.DataFrame, 
         varname: str, 
         figsize: Tuple[int, int] = (800,600), 
         cap: Union[float, int] = None, 
-        backend:str = 'plotly'):
+        backend:str = 'plotly',
+        cap_quantile: float = None):
 
         """
         Plot the histogram of the chosen variable.
@@ -131,18 +164,25 @@ class Plotter:
             cap (float, int): Used to filter outliers
             backend (str): Define the library used for plots. Default is plotly as is interactive. Other choice is 'pyplot'
             which is seaborn/matplotlib based and is static.
+            cap_quantile (float): Used to filter outliers automatically. The cap and the histogram range are read
+            from a quantile sketch of the variable, e.g. 0.99 drops the top 1%. Ignored if cap is given.
         
         """
         # TODO -> Add Docstring -> DONE
         # TODO -> Add Typing -> DONE
+        hist_range = None
+        if not cap and cap_quantile:
+            sketch = QuantileSketch.from_values(data[varname])
+            cap = sketch.quantile(cap_quantile)
+            hist_range = (sketch.min, cap)
+
         if cap:
             mask = data[varname] < cap
             data = data[mask]
 
         control, variant = Loader.extract_series_from_data(data, varname)
 
-        if backend == "plotly":
-            f = PlotlyBackend.make_hist(control, variant, figsize=figsize)
+        f = cls.get_backend(backend).make_hist(control, variant, figsize=figsize, hist_range=hist_range)
 
         return f
 
@@ -154,6 +194,7 @@ class Plotter:
         quantiles_summary: pd.DataFrame, 
         varname: str, 
         figsize: Tuple[int, int] = (800,600),
+        ci: float = 95,
         backend: str = "plotly"
         ):
 
@@ -165,6 +206,7 @@ class Plotter:
             quantiles_summary (pd.DataFrame): Dataframe with the test data. 
             varname (str): Chosen variable for analysis, used just in the title.
             figsize (int, int) : A (width, height) tuple that specifies the size of the returned figure.
+            ci (float): Confidence level of the intervals, used just in the legend.
             backend (str): Define the library used for plots. Default is plotly as is interactive. Other choice is 'pyplot'
             which is seaborn/matplotlib based and is static.
 
@@ -180,13 +222,13 @@ class Plotter:
 
         # Generate graph
         # TODO -> Abstract in a function that unpacks the desired columns -> NOT NEEDED/DONE
-        if backend == "plotly":
-            f = PlotlyBackend.make_quantile(quantiles_summary, varname, figsize)
+        f = cls.get_backend(backend).make_quantile(quantiles_summary, varname, figsize, ci)
 
         return f
 
-    @staticmethod
+    @classmethod
     def plot_h0_results(
+        cls,
         modeled_h0: np.array, 
         exp_test: float,
         varname: str, 
@@ -210,7 +252,6 @@ class Plotter:
             f: Figure Object
 
         """
-        if backend == 'plotly':
-            f = PlotlyBackend.make_h0_hist(modeled_h0, exp_test, varname, figsize)
+        f = cls.get_backend(backend).make_h0_hist(modeled_h0, exp_test, varname, figsize)
             
         return f
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+from signf_app.bootstrapper import Bootstrapper
+
+
+class ReplicateStore:
+    """
+    The ReplicateStore keeps the raw results of the simulations of a test so they never have to be
+    recomputed when only the way we read them changes (alpha, CI level or the quantiles to plot).
+    It holds two compact replicate matrices:
+        - The differences of means simulated under H0 by resampler.Resampler, from which the p-val is read.
+        - The bootstrapped quantiles of control and variant on a fine internal quantile grid, from which
+        the quantile treatment effect is summarized for any CI level and any subset of quantiles.
+
+    Both parts are optional so they can be filled lazily, e.g. the quantiles are not needed for proportions.
+
+    Attributes:
+        test_statistic (float): Observed difference of means between variant and control
+        h0_diffs (np.array): Differences of means simulated under H0
+        quantile_grid (np.array): Quantiles of the columns of the bootstrap matrices
+        control_quantiles (np.array): (n_iter, len(quantile_grid)) bootstrapped quantiles of control
+        variant_quantiles (np.array): (n_iter, len(quantile_grid)) bootstrapped quantiles of variant
+    """
+
+    QUANTILE_GRID = np.round(np.arange(0.001, 1, 0.001), 3)
+
+    def __init__(
+        self,
+        test_statistic: float = None,
+        h0_diffs: np.array = None,
+        quantile_grid: np.array = None,
+        control_quantiles: np.array = None,
+        variant_quantiles: np.array = None
+        ) -> None:
+        self.test_statistic = test_statistic
+        self.h0_diffs = h0_diffs
+        self.quantile_grid = quantile_grid
+        self.control_quantiles = control_quantiles
+        self.variant_quantiles = variant_quantiles
+
+    @property
+    def has_h0(self) -> bool:
+        return self.h0_diffs is not None
+
+    @property
+    def has_quantiles(self) -> bool:
+        return self.control_quantiles is not None
+
+    def p_value(self) -> float:
+        """
+        Returns the p-val of the observed treatment effect with respect to the H0 simulation, taking
+        into account in which tail the effect is.
+        """
+        p_sim = (self.h0_diffs <= self.test_statistic).mean()
+        return min([p_sim, 1 - p_sim])
+
+    def _grid_index(self, q: np.array) -> np.array:
+        """
+        Maps each requested quantile to the nearest column of the internal quantile grid.
+        """
+        q = np.clip(np.asarray(q, dtype=float), self.quantile_grid[0], self.quantile_grid[-1])
+        idx = np.clip(np.searchsorted(self.quantile_grid, q), 1, len(self.quantile_grid) - 1)
+        left_closer = (q - self.quantile_grid[idx - 1]) <= (self.quantile_grid[idx] - q)
+        return idx - left_closer
+
+    def summarize_quantile_effect(self, q: np.array = None, ci: float = 95) -> pd.DataFrame:
+        """
+        Summarize the stored bootstrap replicates into the quantile treatment effect. Quantiles that are
+        not on the internal grid are read from its nearest point.
+
+        Args:
+            q (np.array): the quantiles to summarize. By default the whole internal grid.
+            ci (float): Confidence level of the interval, in percent
+
+        Returns:
+            data (pd.DataFrame): Dataframe with the scheme of bootstrapper.Bootstrapper.summarize_quantile_effect
+        """
+        if q is None:
+            q = self.quantile_grid
+        idx = self._grid_index(q)
+        return Bootstrapper.summarize_quantile_replicates(
+            self.control_quantiles[:, idx],
+            self.variant_quantiles[:, idx],
+            np.asarray(q),
+            ci
+            )
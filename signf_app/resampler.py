@@ -1,7 +1,10 @@
 # simulate effect under H0
+from typing import Tuple
+
 import numpy as np
 import pandas as pd
 
+from signf_app.common import get_strata_layout
 
 
 class Resampler:
@@ -68,3 +71,129 @@ class Resampler:
             control_perm.append(c)
             variation_perm.append(v)
         return control_perm, variation_perm
+
+
+    def simulate_cont_under_h0_stratified(
+        self, 
+        control: pd.Series, 
+        variation: pd.Series, 
+        control_strata: pd.Series, 
+        variation_strata: pd.Series, 
+        n_iter: int = 1000,
+        max_batch_cells: int = 2 ** 22
+        ) -> Tuple[np.array, np.array]:
+        """
+        Performs a n_iter number of permutation tests for control and variation where the labels are only
+        shuffled within each stratum (day, country, platform...). The pooled data is sorted once by stratum and
+        every permutation is a segmented shuffle: adding a uniform [0, 1) noise to the integer stratum code and
+        sorting keeps each stratum in its own segment while shuffling the rows inside it, so the cost does not 
+        grow with the number of strata. The permutations are drawn in batches of at most max_batch_cells values
+        and each batch is reduced to the means of the iterations, so the memory stays bounded.
+
+        Args:
+            control (pd.Series): Values of the chosen variable in the control group
+            variation (pd.Series): Values of the chosen variable in the variation group
+            control_strata (pd.Series): Stratum of each row of control
+            variation_strata (pd.Series): Stratum of each row of variation
+            n_iter (int): Number of permutations
+            max_batch_cells (int): Maximum size of a batch of permutations
+
+        Returns:
+            control_means (np.array): Mean of the permuted control values of each iteration
+            variation_means (np.array): Mean of the permuted variation values of each iteration
+        """
+        n, m = len(control), len(variation)
+        data = np.append(control, variation).astype(float)
+        is_control = np.arange(len(data)) < n
+        order, codes, _, _ = get_strata_layout(np.append(control_strata, variation_strata))
+        data, is_control = data[order], is_control[order]
+        control_slots = np.flatnonzero(is_control)
+
+        total = data.sum()
+        batch_size = max(1, max_batch_cells // len(data))
+        control_sums = []
+        for start in range(0, n_iter, batch_size):
+            idx = self._shuffle_within_strata(codes, min(batch_size, n_iter - start))
+            control_sums.append(data[idx[:, control_slots]].sum(axis=1))
+        control_sums = np.concatenate(control_sums)
+        return control_sums / n, (total - control_sums) / m
+
+    def _shuffle_within_strata(self, codes: np.array, n_iter: int) -> np.array:
+        """
+        Segmented shuffle of rows sorted by their integer stratum codes. Adding a uniform [0, 1) noise to the 
+        codes and sorting shuffles the rows of each stratum without leaving its segment.
+        Returns a (n_iter, len(codes)) array of indices with one permutation per row.
+        """
+        keys = codes + self.nrg.random(size=(n_iter, len(codes)))
+        return np.argsort(keys, axis=1)
+
+    def _permute_within_strata(self, data: np.array, codes: np.array, n_iter: int) -> np.array:
+        """
+        Same as _shuffle_within_strata but returns the permuted data instead of the indices.
+        """
+        return data[self._shuffle_within_strata(codes, n_iter)]
+
+    def simulate_segment_diffs_under_h0(
+        self, 
+        values: np.array, 
+        is_control: np.array, 
+        segment_codes: np.array, 
+        n_segments: int, 
+        strata: np.array = None, 
+        n_iter: int = 1000, 
+        max_batch_cells: int = 2 ** 22
+        ) -> np.array:
+        """
+        Simulates the H0 of every segment at once. The labels are permuted within each segment (and stratum if 
+        given) in a single segmented shuffle, and the differences of means of all the segments are read from a 
+        cumulative sum: the rows are laid out by (segment, stratum, control first), so the control and variation 
+        rows of each cell are contiguous and their sums are differences of the cumulative sum at the boundaries.
+        The permutations are drawn in batches of at most max_batch_cells values.
+
+        Rows with missing values should be dropped before, otherwise every permuted sum of their segment is NaN.
+
+        Args:
+            values (np.array): Values of the chosen variable for control and variation
+            is_control (np.array): Boolean mask of the control rows
+            segment_codes (np.array): Integer code of the segment of each row, from 0 to n_segments - 1
+            n_segments (int): Number of segments. It sets the columns of the result
+            strata (np.array): Optional stratum of each row. Permutations are then confined within (segment, stratum)
+            n_iter (int): Number of permutations
+            max_batch_cells (int): Maximum size of a batch of permutations
+
+        Returns:
+            diffs (np.array): (n_iter, n_segments) differences of means variation - control under H0, column i 
+            being the segment with code i. Segments without control or variation rows are NaN.
+        """
+        values, is_control = np.asarray(values, dtype=float), np.asarray(is_control, dtype=bool)
+        segment_codes = np.asarray(segment_codes, dtype=np.int64)
+        strata_codes = np.zeros(len(values), dtype=np.int64)
+        if strata is not None:
+            strata_codes = pd.factorize(np.asarray(strata), use_na_sentinel=False)[0]
+        n_strata = strata_codes.max() + 1 if len(values) else 1
+
+        group = segment_codes * n_strata + strata_codes
+        order = np.lexsort((~is_control, group))
+        values, group, is_control = values[order], group[order], is_control[order]
+
+        # Every (group, arm) cell and the segment and arm it adds to
+        cells, starts, counts = np.unique(group * 2 + ~is_control, return_index=True, return_counts=True)
+        cell_segment, cell_is_variant = cells // 2 // n_strata, cells % 2 == 1
+        indicator = np.zeros((len(cells), 2 * n_segments))
+        indicator[np.arange(len(cells)), cell_segment + n_segments * cell_is_variant] = 1
+        n = counts @ indicator
+
+        batch_size = max(1, max_batch_cells // max(1, len(values)))
+        diffs = []
+        for start in range(0, n_iter, batch_size):
+            permuted = self._permute_within_strata(values, group, min(batch_size, n_iter - start))
+            # Sums of every cell from the cumulative sum at the cell boundaries
+            cumsum = np.zeros((len(permuted), len(values) + 1))
+            np.cumsum(permuted, axis=1, out=cumsum[:, 1:])
+            sums = (cumsum[:, starts + counts] - cumsum[:, starts]) @ indicator
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                means = sums / n
+            diffs.append(means[:, n_segments:] - means[:, :n_segments])
+        return np.concatenate(diffs)
+
@@ -0,0 +1,171 @@
+from typing import Iterable, List, Union
+
+import numpy as np
+import pandas as pd
+
+
+class QuantileSketch:
+    """
+    The QuantileSketch class is a mergeable quantile sketch (KLL style) to summarize a metric in bounded memory.
+    Values are pushed in chunks into a stack of compactors. The compactor at level h keeps items that represent
+    2^h values each; when a compactor is full it's sorted and every other item (starting at a random offset) is
+    promoted to the next level. Since compactors of the same level can just be concatenated, sketches built on
+    different chunks or workers can be merged and the result has the same guarantees as a single sketch.
+
+    Any quantile is answered within a normalized rank error of about rank_error, with a memory of a few times
+    3.3 / rank_error values regardless of the number of rows. Min, max and count are kept exactly.
+
+    Reference: Karnin, Lang, Liberty. Optimal Quantile Approximation in Streams (https://arxiv.org/abs/1603.05346)
+
+    Attributes:
+        rank_error (float): Target normalized rank error of the answered quantiles. Set to 0.01 by default
+        k (int): Capacity of the top compactor, derived from rank_error
+        n (int): Number of values summarized
+    """
+
+    # Capacity decay of the lower compactors
+    _C = 2 / 3
+
+    def __init__(self, rank_error: float = 0.01, nrg: np.random = np.random.default_rng()) -> None:
+        if not 0 < rank_error < 1:
+            raise Exception('rank_error should be between 0 and 1')
+
+        self.rank_error = rank_error
+        self.k = max(8, int(np.ceil(3.3 / rank_error)))
+        self.nrg = nrg
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.compactors: List[np.array] = [np.empty(0)]
+
+    def _capacity(self, level: int) -> int:
+        """
+        Capacity of the compactor at level. The top compactor holds k items and each one below 2/3 of that.
+        """
+        depth = len(self.compactors) - level - 1
+        return max(2, int(np.ceil(self.k * self._C ** depth)))
+
+    def _compress(self) -> None:
+        """
+        Compacts every compactor over its capacity, promoting half of its items to the next level.
+        """
+        level = 0
+        while level < len(self.compactors):
+            items = self.compactors[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append(np.empty(0))
+                items = np.sort(items)
+                # An odd item stays at this level so the total weight is preserved
+                keep = items[-1:] if len(items) % 2 else items[:0]
+                pairs = items[:len(items) - len(keep)]
+                promoted = pairs[self.nrg.integers(2)::2]
+                self.compactors[level] = keep
+                self.compactors[level + 1] = np.append(self.compactors[level + 1], promoted)
+            level += 1
+
+    def update(self, values: Union[pd.Series, np.array]) -> "QuantileSketch":
+        """
+        Adds a chunk of values to the sketch. Missing values are ignored.
+
+        Args:
+            values (pd.Series, np.array): Chunk of values of the metric
+
+        Returns:
+            self (QuantileSketch): The updated sketch, to allow chaining
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+
+        self.n += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.compactors[0] = np.append(self.compactors[0], values)
+        self._compress()
+        return self
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        """
+        Merges another sketch into this one, e.g. the sketch of another chunk or worker.
+
+        Args:
+            other (QuantileSketch): Sketch to merge
+
+        Returns:
+            self (QuantileSketch): The merged sketch
+        """
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.empty(0))
+        for level, items in enumerate(other.compactors):
+            self.compactors[level] = np.append(self.compactors[level], items)
+
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    @classmethod
+    def from_values(cls, values: Union[pd.Series, np.array], rank_error: float = 0.01, **kwargs) -> "QuantileSketch":
+        """
+        Builds a sketch from a single array of values.
+        """
+        return cls(rank_error, **kwargs).update(values)
+
+    @classmethod
+    def merge_all(cls, sketches: Iterable["QuantileSketch"]) -> "QuantileSketch":
+        """
+        Merges a collection of sketches into a new one.
+        """
+        sketches = list(sketches)
+        merged = cls(min(s.rank_error for s in sketches), sketches[0].nrg)
+        for s in sketches:
+            merged.merge(s)
+        return merged
+
+    def quantile(self, q: Union[float, np.array]) -> Union[float, np.array]:
+        """
+        Approximate quantiles of the summarized values.
+
+        Args:
+            q (float, np.array): the quantiles to compute. They should be between 0 and 1.
+
+        Returns:
+            quantiles (float, np.array): The approximate quantiles, with the same shape as q
+        """
+        if self.n == 0:
+            raise Exception('The sketch is empty')
+
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(len(c), 2.0 ** h) for h, c in enumerate(self.compactors)])
+        order = np.argsort(items, kind="stable")
+        items, cum_weights = items[order], np.cumsum(weights[order])
+
+        q = np.asarray(q, dtype=float)
+        idx = np.searchsorted(cum_weights, q * cum_weights[-1], side="left")
+        quantiles = items[np.clip(idx, 0, len(items) - 1)]
+        # The extremes are known exactly
+        quantiles = np.where(q <= 0, self.min, np.where(q >= 1, self.max, quantiles))
+        return quantiles if quantiles.ndim else float(quantiles)
+
+    def winsorize(
+        self,
+        values: Union[pd.Series, np.array],
+        lower: float = 0.0,
+        upper: float = 0.99
+        ) -> Union[pd.Series, np.array]:
+        """
+        Caps the outliers of values to the approximate lower and upper quantiles of the sketch.
+
+        Args:
+            values (pd.Series, np.array): Values to winsorize
+            lower (float): Lower quantile of the cap. By default no lower cap.
+            upper (float): Upper quantile of the cap
+
+        Returns:
+            values (pd.Series, np.array): The winsorized values
+        """
+        low, high = self.quantile([lower, upper])
+        return values.clip(low, high) if isinstance(values, pd.Series) else np.clip(values, low, high)
@@ -0,0 +1,110 @@
+from abc import ABC, abstractmethod
+from typing import Iterator
+
+import pandas as pd
+
+
+class SQLSource(ABC):
+    """
+    The SQLSource class is the interface the Loader uses to talk to a database. A source only needs to run a
+    query and stream its result in batches; the SQL itself is written by the Loader so the aggregations are
+    pushed into the database and only compact results cross the wire.
+
+    The few dialect differences the Loader relies on (quoting identifiers and flooring numbers) are methods
+    so a new database is supported by subclassing, which only has to implement iter_batches.
+    """
+
+    def query(self, sql: str) -> pd.DataFrame:
+        """
+        Runs sql and returns the whole result. Meant for aggregated, small results.
+        """
+        batches = list(self.iter_batches(sql))
+        return pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
+
+    @abstractmethod
+    def iter_batches(self, sql: str, batch_size: int = 100_000) -> Iterator[pd.DataFrame]:
+        """
+        Runs sql and yields its result in DataFrames of at most batch_size rows. A result without rows
+        yields a single empty DataFrame with its columns, so callers can always rely on the schema.
+        """
+
+    @staticmethod
+    def quote(identifier: str) -> str:
+        return '"' + identifier.replace('"', '""') + '"'
+
+    @staticmethod
+    def floor(expression: str) -> str:
+        return f"FLOOR({expression})"
+
+
+class DBAPISource(SQLSource):
+    """
+    Source for any DB-API 2.0 connection, e.g. DuckDB or a local stand-in of the warehouse.
+    """
+
+    def __init__(self, connection) -> None:
+        self.connection = connection
+
+    def iter_batches(self, sql: str, batch_size: int = 100_000) -> Iterator[pd.DataFrame]:
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql)
+            columns = [d[0] for d in cursor.description]
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                yield pd.DataFrame(columns=columns)
+            while rows:
+                yield pd.DataFrame.from_records(rows, columns=columns)
+                rows = cursor.fetchmany(batch_size)
+        finally:
+            cursor.close()
+
+
+class SQLiteSource(DBAPISource):
+    """
+    Source for a sqlite3 connection. SQLite may be built without FLOOR, but casting to INTEGER truncates
+    which is the same for the non negative values the Loader floors.
+    """
+
+    @staticmethod
+    def floor(expression: str) -> str:
+        return f"CAST({expression} AS INTEGER)"
+
+
+class BigQuerySource(SQLSource):
+    """
+    Source for Google BigQuery. The client and the credentials are created on the first query, so creating
+    the source never triggers the authentication flow.
+    """
+
+    SCOPES = ["https://www.googleapis.com/auth/bigquery"]
+
+    def __init__(self, project: str = None, credentials=None) -> None:
+        self.project = project
+        self.credentials = credentials
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from google.cloud import bigquery
+
+            if self.credentials is None:
+                import pydata_google_auth
+
+                self.credentials = pydata_google_auth.get_user_credentials(self.SCOPES)
+            self._client = bigquery.Client(project=self.project, credentials=self.credentials)
+        return self._client
+
+    def iter_batches(self, sql: str, batch_size: int = 100_000) -> Iterator[pd.DataFrame]:
+        rows = self.client.query(sql).result(page_size=batch_size)
+        empty = True
+        for batch in rows.to_dataframe_iterable():
+            empty = False
+            yield batch
+        if empty:
+            yield pd.DataFrame(columns=[field.name for field in rows.schema])
+
+    @staticmethod
+    def quote(identifier: str) -> str:
+        return "`" + identifier.replace("`", "\\`") + "`"